@@ -1,38 +1,249 @@
 import os
-import gradio as gr
-from huggingface_hub import HfApi, login
+import asyncio
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
 from dotenv import load_dotenv
 
-from llm import get_groq_llm
-from vectorstore import get_chroma_vectorstore
-from embeddings import get_SFR_Code_embedding_model
-from kadi_apy_ragchain import KadiApyRagchain
+from config_loader import load_config, get_vectorstore_version
+from vectorstore_manifest import read_manifest, MANIFEST_FILENAME
+from tracing import Tracer
+
+# Everything that pulls in torch, transformers or langchain is imported by the background loader in load_ragchain,
+# so the UI can bind before the models are loaded
 
 load_dotenv()
 
 vectorstore_path = "data/vectorstore"
+update_history_path = "update_history.json"
+app_settings_path = "config_files/app_settings.json"
+gitlab_hf_settings_path = "config_files/gitlab_hf_settings.json"
 
 GROQ_API_KEY = os.environ["GROQ_API_KEY"]
 HF_TOKEN = os.environ["HF_Token"]
 
-login(HF_TOKEN)
-hf_api = HfApi()
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def log_duration(label):
+    start_time = time.perf_counter()
+    yield
+    logger.info(f"{label} took {time.perf_counter() - start_time:.2f}s")
 
 
 
 class KadiBot:
-    def __init__(self, llm, vectorstore):
-        self.kadiAPY_ragchain = KadiApyRagchain(llm, vectorstore)
+    def __init__(self, load_ragchain):
+        """
+        Parameters:
+            load_ragchain (callable): Builds the KadiApyRagchain, called once in a background thread by start_loading.
+        """
+        self.kadiAPY_ragchain = None
+        self.load_error = None
+        self.ready = threading.Event()
+        self._load_ragchain = load_ragchain
+
+        # Requests in progress per vectorstore generation, so old indexes are only released once drained
+        self._generation = 0
+        self._requests_in_progress = {}
+        self._requests_changed = threading.Condition()
 
-    def handle_chat(self, chat_history):
+    def start_loading(self):
+        threading.Thread(target=self._load, name="kadi-bot-loader", daemon=True).start()
+
+    def _load(self):
+        try:
+            with log_duration("Loading the models and the vectorstore"):
+                self.kadiAPY_ragchain = self._load_ragchain()
+        except Exception as e:
+            logger.exception("Loading the models and the vectorstore failed")
+            self.load_error = e
+        finally:
+            self.ready.set()
+
+    async def handle_chat(self, chat_history):
         if not chat_history:
-            return chat_history
+            yield chat_history
+            return
         
         user_query = chat_history[-1][0]
-        response = self.kadiAPY_ragchain.process_query(user_query, chat_history)
-        chat_history[-1] = (user_query, response)
+        # The ragchain gets its own copy, taken before any status text is written into the last turn,
+        # so neither the startup nor the progress messages end up in the prompt or count as a response
+        query_history = list(chat_history)
+
+        # Requests arriving during startup wait until the background loader is done
+        if not self.ready.is_set():
+            chat_history[-1] = (user_query, "*The assistant is starting up, your question is answered in a moment...*")
+            yield chat_history
+            await asyncio.to_thread(self.ready.wait)
+
+        if self.load_error is not None:
+            chat_history[-1] = (user_query, f"The assistant could not be started: {self.load_error}")
+            yield chat_history
+            return
+
+        generation = self._begin_request()
+        try:
+            response = ""
+            async for event, text in self.kadiAPY_ragchain.astream_query(user_query, query_history):
+                if event == "status":
+                    chat_history[-1] = (user_query, f"*{text}*")
+                else:
+                    response += text
+                    chat_history[-1] = (user_query, response)
+                yield chat_history
+        finally:
+            self._end_request(generation)
+
+    def swap_indexes(self, vector_store, lexical_index, usage_router, symbol_table):
+        """
+        Switches the ragchain to the indexes of a new vectorstore version. Blocks until all requests that
+        started before the swap are finished and only then drops the old indexes.
+        """
+        with self._requests_changed:
+            old_indexes = self.kadiAPY_ragchain.swap_indexes(vector_store, lexical_index, usage_router, symbol_table)
+            old_generation = self._generation
+            self._generation += 1
+
+            self._requests_changed.wait_for(
+                lambda: not any(count for generation, count in self._requests_in_progress.items() if generation <= old_generation)
+            )
+        # The last references to the old indexes, e.g. the open Chroma client or the memory-mapped matrix
+        del old_indexes
+
+    def _begin_request(self):
+        with self._requests_changed:
+            generation = self._generation
+            self._requests_in_progress[generation] = self._requests_in_progress.get(generation, 0) + 1
+            return generation
+
+    def _end_request(self, generation):
+        with self._requests_changed:
+            self._requests_in_progress[generation] -= 1
+            if not self._requests_in_progress[generation]:
+                del self._requests_in_progress[generation]
+            self._requests_changed.notify_all()
+
+
+class VectorstoreWatcher:
+    """
+    Polls the separate Hugging Face repository (hf_vectorstore_repo_id) the update pipeline publishes the
+    vectorstore to. A new version is downloaded into its own directory, loaded in the background and swapped
+    into the running KadiBot, the embedding model and the warm caches that stay valid are kept. The files of the
+    served version are never touched, the directory of a replaced version is deleted once the requests using it
+    are drained. The first poll happens on startup, so a Space started with an older vectorstore catches up.
+
+    If the vectorstore is published into the repository of the Space itself, every upload restarts the Space
+    and the new version is loaded on startup anyway, so the watcher is not started.
+    """
+
+    def __init__(self, kadi_bot, app_settings, hf_settings, poll_interval_seconds=60, download_directory="data/vectorstore_versions"):
+        """
+        Parameters:
+            hf_settings (dict): The huggingface_parameters of the GitLab and Hugging Face settings.
+            download_directory (str): Directory the new versions are downloaded to, one subdirectory per commit.
+        """
+        self.kadi_bot = kadi_bot
+        self.app_settings = app_settings
+        self.hf_settings = hf_settings
+        self.poll_interval_seconds = poll_interval_seconds
+        self.download_directory = download_directory
+        self._revision = None
+        self._manifest = None
+        self._served_version_directory = None
 
-        return chat_history
+    def start(self):
+        if not self.hf_settings.get("hf_vectorstore_repo_id"):
+            logger.warning(
+                "Hot-swapping needs the vectorstore to be published to its own repository (hf_vectorstore_repo_id), "
+                "the vectorstore watcher is not started."
+            )
+            return
+        threading.Thread(target=self._run, name="vectorstore-watcher", daemon=True).start()
+
+    def _run(self):
+        self.kadi_bot.ready.wait()
+        if self.kadi_bot.load_error is not None:
+            return
+
+        self._manifest = read_manifest(vectorstore_path)
+        # Versions downloaded before a restart are not served anymore
+        shutil.rmtree(self.download_directory, ignore_errors=True)
+        while True:
+            try:
+                self._poll()
+            except Exception as e:
+                # E.g. the Hub is not reachable, the commit is checked again with the next poll
+                logger.warning(f"Checking for a new vectorstore version failed: {e}")
+            time.sleep(self.poll_interval_seconds)
+
+    def _poll(self):
+        from huggingface_operations import download_folder_from_huggingface, get_latest_revision, get_vectorstore_repo
+
+        hf_repo_id, hf_repo_type = get_vectorstore_repo(self.hf_settings)
+        hf_vectorstore_path = self.hf_settings["hf_vectorstore_path"]
+
+        revision = get_latest_revision(hf_repo_id, hf_repo_type)
+        if revision == self._revision:
+            return
+
+        with tempfile.TemporaryDirectory() as manifest_directory:
+            manifest = read_manifest(download_folder_from_huggingface(
+                hf_vectorstore_path, hf_repo_id, hf_repo_type, manifest_directory,
+                allow_patterns=[MANIFEST_FILENAME], revision=revision,
+            ))
+        if not manifest or manifest == self._manifest:
+            # The commit did not change the vectorstore, e.g. it only changed the app
+            self._revision = revision
+            return
+        if _embedding_settings(manifest) != _embedding_settings(self._manifest):
+            logger.warning("The new vectorstore version needs another embedding model, restart the app to load it.")
+            self._revision = revision
+            return
+
+        version_directory = os.path.join(self.download_directory, revision)
+        with log_duration(f"Downloading the vectorstore at commit {revision}"):
+            version_path = download_folder_from_huggingface(
+                hf_vectorstore_path, hf_repo_id, hf_repo_type, version_directory, revision=revision
+            )
+
+        # A broken version is not retried until the next commit
+        self._revision = revision
+        try:
+            self._swap(version_path, revision)
+        except Exception:
+            logger.exception(f"Loading the vectorstore at commit {revision} failed, keeping the current one")
+            shutil.rmtree(version_directory, ignore_errors=True)
+            return
+
+        if self._served_version_directory is not None:
+            shutil.rmtree(self._served_version_directory, ignore_errors=True)
+        self._served_version_directory = version_directory
+        self._manifest = manifest
+
+    def _swap(self, version_path, revision):
+        from vectorstore import get_vectorstore
+
+        embedding_model = self.kadi_bot.kadiAPY_ragchain.query_embedder.embedding_model
+        with log_duration(f"Loading the vectorstore at commit {revision}"):
+            vectorstore = get_vectorstore(embedding_model, version_path, self.app_settings["vectorstore"]["backend"])
+            lexical_index = get_lexical_index(version_path)
+            usage_router = get_usage_router(version_path, self.app_settings["usage_router"])
+            symbol_table = get_symbol_table(version_path, self.app_settings["symbol_expansion"])
+
+        # Returns once the requests still using the previous version are finished
+        with log_duration("Swapping the vectorstore and draining the requests in progress"):
+            self.kadi_bot.swap_indexes(vectorstore, lexical_index, usage_router, symbol_table)
+
+
+def _embedding_settings(manifest):
+    keys = ("embedding_model", "embedding_model_revision", "embedding_backend", "vector_dimension", "vector_dtype")
+    return {key: manifest.get(key) for key in keys}
 
 
 
@@ -46,11 +257,163 @@ def show_history(chat_history):
     return chat_history
 
 
-def main():
-    vectorstore = get_chroma_vectorstore(get_SFR_Code_embedding_model(), vectorstore_path)
+def get_response_cache(embedding_model, cache_settings):
+    if not cache_settings.get("enabled", False):
+        return None
+
+    from semantic_cache import SemanticResponseCache
+
+    return SemanticResponseCache(
+        embedding_model,
+        similarity_threshold=cache_settings["similarity_threshold"],
+        max_entries=cache_settings["max_entries"],
+        ttl_seconds=cache_settings.get("ttl_seconds"),
+        version_provider=lambda: get_vectorstore_version(update_history_path),
+        version_check_seconds=cache_settings["version_check_seconds"],
+    )
+
+
+def get_llm_result_cache(cache_settings):
+    if not cache_settings.get("enabled", False):
+        return None
+
+    from llm_cache import LLMResultCache
+
+    return LLMResultCache(
+        cache_settings["path"],
+        max_entries=cache_settings["max_entries"],
+        touch_interval_seconds=cache_settings["touch_interval_seconds"],
+    )
+
+
+def get_history_manager(llm, history_settings):
+    from chat_history_manager import ChatHistoryManager
+    from token_counter import get_tokenizer
+
+    return ChatHistoryManager(
+        llm,
+        get_tokenizer(history_settings["tokenizer"]),
+        max_verbatim_turns=history_settings["max_verbatim_turns"],
+        token_budget=history_settings["token_budget"],
+        summary_token_budget=history_settings["summary_token_budget"],
+        max_incremental_turns=history_settings["max_incremental_turns"],
+    )
+
+
+def get_lexical_index(vectorstore_path):
+    from bm25_index import BM25Index, BM25_INDEX_FILENAME
+
+    lexical_index_path = os.path.join(vectorstore_path, BM25_INDEX_FILENAME)
+    if not os.path.exists(lexical_index_path):
+        logger.warning(f"No BM25 index found at {lexical_index_path}, using vector retrieval only.")
+        return None
+
+    return BM25Index.load(lexical_index_path)
+
+
+def get_usage_router(vectorstore_path, router_settings):
+    from library_usage_router import CentroidUsageRouter, USAGE_CENTROIDS_FILENAME
+
+    usage_centroids_path = os.path.join(vectorstore_path, USAGE_CENTROIDS_FILENAME)
+    if not router_settings.get("enabled", False) or not os.path.exists(usage_centroids_path):
+        return None
+
+    return CentroidUsageRouter.load(usage_centroids_path, min_margin=router_settings["min_margin"])
+
+
+def get_symbol_table(vectorstore_path, expansion_settings):
+    if not expansion_settings.get("enabled", False):
+        return None
+
+    from symbol_table import load_symbol_table
+
+    symbol_table = load_symbol_table(vectorstore_path)
+    if symbol_table is None:
+        logger.warning(f"No symbol table found at {vectorstore_path}, retrieved chunks are not expanded.")
+    return symbol_table
+
+
+def get_context_packer(packer_settings):
+    if not packer_settings.get("enabled", False):
+        return None
+
+    from context_packer import ContextPacker
+    from token_counter import get_tokenizer
+
+    return ContextPacker(
+        get_tokenizer(packer_settings["tokenizer"]),
+        doc_token_budget=packer_settings["doc_token_budget"],
+        code_token_budget=packer_settings["code_token_budget"],
+        duplicate_threshold=packer_settings["duplicate_threshold"],
+    )
+
+
+def load_ragchain(app_settings, tracer):
+    """Imports the heavy dependencies, loads the models and the vectorstore and builds the ragchain."""
+    with log_duration("Importing the model dependencies"):
+        from huggingface_hub import login
+        from llm import get_groq_llm
+        from vectorstore import get_vectorstore, get_query_embedding_model
+        from embeddings import QueryEmbeddingCache
+        from kadi_apy_ragchain import KadiApyRagchain
+
+    login(HF_TOKEN)
+
+    with log_duration("Loading the embedding model"):
+        embedding_model = get_query_embedding_model(vectorstore_path)
+    with log_duration("Opening the vectorstore"):
+        vectorstore = get_vectorstore(embedding_model, vectorstore_path, app_settings["vectorstore"]["backend"])
     llm = get_groq_llm("qwen-2.5-coder-32b", "0.0", GROQ_API_KEY)
-    
-    kadi_bot = KadiBot(llm, vectorstore)
+    query_embedder = QueryEmbeddingCache(embedding_model, max_entries=app_settings["query_embedding_cache"]["max_entries"])
+    # The response cache embeds through the query embedder, so the raw query is embedded once per request
+    response_cache = get_response_cache(query_embedder, app_settings["semantic_cache"])
+    llm_result_cache = get_llm_result_cache(app_settings["llm_result_cache"])
+    with log_duration("Loading the tokenizers and the indexes"):
+        history_manager = get_history_manager(llm, app_settings["chat_history"])
+        lexical_index = get_lexical_index(vectorstore_path)
+        usage_router = get_usage_router(vectorstore_path, app_settings["usage_router"])
+        symbol_table = get_symbol_table(vectorstore_path, app_settings["symbol_expansion"])
+        context_packer = get_context_packer(app_settings["context_packer"])
+
+    return KadiApyRagchain(
+        llm,
+        vectorstore,
+        response_cache=response_cache,
+        llm_result_cache=llm_result_cache,
+        history_manager=history_manager,
+        query_embedder=query_embedder,
+        lexical_index=lexical_index,
+        usage_router=usage_router,
+        tracer=tracer,
+        context_packer=context_packer,
+        symbol_table=symbol_table,
+        max_expanded_chunks=app_settings["symbol_expansion"]["max_expanded_chunks"],
+    )
+
+
+def main():
+    app_settings = load_config(app_settings_path)
+    tracing_settings = app_settings["tracing"]
+    # Set the log level to DEBUG to log every traced stage and the retrieved snippets
+    logging.basicConfig(level=tracing_settings["log_level"], format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    tracer = Tracer(window_size=tracing_settings["window_size"])
+
+    # The models load in the background while the UI is built and bound
+    kadi_bot = KadiBot(lambda: load_ragchain(app_settings, tracer))
+    kadi_bot.start_loading()
+
+    hot_swap_settings = app_settings["hot_swap"]
+    if hot_swap_settings.get("enabled", False):
+        VectorstoreWatcher(
+            kadi_bot,
+            app_settings,
+            load_config(gitlab_hf_settings_path)["huggingface_parameters"],
+            poll_interval_seconds=hot_swap_settings["poll_interval_seconds"],
+            download_directory=hot_swap_settings["download_directory"],
+        ).start()
+
+    with log_duration("Importing gradio"):
+        import gradio as gr
     
     with gr.Blocks() as demo:
         gr.Markdown("## KadiAPY - AI Coding-Assistant")
@@ -85,6 +448,13 @@ def main():
                         cache_examples=False,
                         examples_per_page=3,
                     )
+
+        # Hidden unless enabled in the app settings
+        with gr.Tab("Metrics", visible=tracing_settings["metrics_tab_visible"]):
+            metrics_txt = gr.Code(label="Stage latencies and counters (Prometheus text format)", interactive=False)
+            refresh_metrics_btn = gr.Button("Refresh")
+        
+        refresh_metrics_btn.click(tracer.to_prometheus_text, [], [metrics_txt])
         
         user_txt.submit(add_text_to_chat_history, [chat_history, user_txt], [chat_history, user_txt]).then(show_history, [chat_history], [chatbot])\
                   .then(kadi_bot.handle_chat, [chat_history], [chatbot])          
@@ -94,6 +464,8 @@ def main():
         clear_chat_btn.click(lambda: ([], ""), [], [chat_history, chatbot]) 
 
 
+    if not kadi_bot.ready.is_set():
+        logger.info("Launching the UI while the models are still loading.")
     demo.launch()
 
 
@@ -0,0 +1,77 @@
+import argparse
+import ast
+import logging
+import random
+import time
+
+from chunking import chunk_pythoncode_and_add_metadata, _SourceLines
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def generate_module(number_of_classes, methods_per_class=10, seed=0):
+    """Generates a synthetic module with decorated methods of varying length, similar to the kadi_apy managers."""
+    rng = random.Random(seed)
+    lines = ["import os", ""]
+    for class_index in range(number_of_classes):
+        lines.append(f"class Manager{class_index}(Base):")
+        lines.append(f'    """Manager number {class_index}."""')
+        for method_index in range(methods_per_class):
+            if method_index % 3 == 0:
+                lines.append("    @property")
+            lines.append(f"    def method_{method_index}(self, record_id):")
+            for line_index in range(rng.randint(2, 30)):
+                lines.append(f"        value_{line_index} = self.get_record(record_id, {line_index})")
+            lines.append("        return record_id")
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def slice_nodes_per_node_split(code_file_content, nodes):
+    """The previous slicing, splitting the whole file again for every class and method."""
+    for node in nodes:
+        "\n".join(code_file_content.splitlines()[node.lineno - 1:node.end_lineno])
+
+
+def slice_nodes_with_line_index(code_file_content, nodes):
+    """The current slicing out of one line index per file."""
+    source_lines = _SourceLines(code_file_content)
+    for node in nodes:
+        source_lines.segment(node.lineno, node.end_lineno)
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the AST chunking on synthetic modules of growing size.")
+    parser.add_argument("--classes", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--max-chunk-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    for number_of_classes in args.classes:
+        module = generate_module(number_of_classes)
+        number_of_lines = module.count("\n")
+        # Parsing is the same for both, so only the slicing of the class and method sources is compared
+        nodes = [node for node in ast.walk(ast.parse(module)) if isinstance(node, (ast.ClassDef, ast.FunctionDef))]
+
+        per_node_split_time = timed(slice_nodes_per_node_split, module, nodes)
+        line_index_time = timed(slice_nodes_with_line_index, module, nodes)
+        chunking_time = timed(chunk_pythoncode_and_add_metadata, [module], ["kadi_apy/lib/synthetic.py"], args.max_chunk_size)
+
+        logging.info(
+            f"{number_of_lines} lines, {len(nodes)} nodes: per-node split {per_node_split_time * 1000:.1f}ms, "
+            f"line index {line_index_time * 1000:.1f}ms (speedup {per_node_split_time / line_index_time:.1f}x), "
+            f"full chunking {chunking_time * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
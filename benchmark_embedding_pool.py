@@ -0,0 +1,77 @@
+import argparse
+import logging
+import os
+import random
+import time
+
+import numpy as np
+
+from embeddings import ParallelEmbeddings
+from token_counter import get_tokenizer
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+MODEL_NAME = "Salesforce/SFR-Embedding-Code-400M_R"
+
+
+def generate_documents(number_of_documents, seed=0):
+    """Generates code-like documents with the wide length spread of the real chunks."""
+    rng = random.Random(seed)
+    words = ["record", "collection", "upload", "file", "metadata", "self", "return", "def", "id", "manager", "group", "user"]
+    documents = []
+    for _ in range(number_of_documents):
+        number_of_lines = rng.choice([1, 2, 5, 10, 20, 30])
+        lines = [" ".join(rng.choice(words) for _ in range(rng.randint(3, 8))) for _ in range(number_of_lines)]
+        documents.append("\n".join(lines))
+    return documents
+
+
+def benchmark(documents, num_workers, torch_threads_per_worker, batch_size):
+    with ParallelEmbeddings(
+        MODEL_NAME,
+        num_workers=num_workers,
+        torch_threads_per_worker=torch_threads_per_worker,
+        tokenizer=get_tokenizer(MODEL_NAME),
+        batch_size=batch_size,
+    ) as embedding_model:
+        # Make sure every worker has loaded its model replica before timing
+        embedding_model._embed_batches([["warm up"]] * num_workers)
+
+        start_time = time.perf_counter()
+        embeddings = embedding_model.embed_documents(documents)
+        elapsed_time = time.perf_counter() - start_time
+
+    return np.asarray(embeddings, dtype=np.float32), elapsed_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the multi-process embedding pool from 1 to N workers.")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--torch-threads-per-worker", type=int, default=1)
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    documents = generate_documents(args.documents)
+    baseline_embeddings = None
+    baseline_time = None
+
+    for num_workers in range(1, args.max_workers + 1):
+        embeddings, elapsed_time = benchmark(documents, num_workers, args.torch_threads_per_worker, args.batch_size)
+
+        if baseline_embeddings is None:
+            baseline_embeddings, baseline_time = embeddings, elapsed_time
+        max_difference = float(np.max(np.abs(embeddings - baseline_embeddings)))
+
+        logging.info(
+            f"{num_workers} worker(s): {elapsed_time:.1f}s, {len(documents) / elapsed_time:.1f} docs/sec, "
+            f"speedup {baseline_time / elapsed_time:.2f}x, max difference to 1 worker {max_difference:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
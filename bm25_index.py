@@ -0,0 +1,143 @@
+import gzip
+import heapq
+import json
+import math
+import re
+from collections import Counter
+
+from langchain.schema import Document
+
+from metadata_filter import matches_filter
+
+BM25_INDEX_FILENAME = "bm25_index.json.gz"
+
+_WORD_PATTERN = re.compile(r"[A-Za-z0-9_]+")
+_CAMEL_CASE_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+
+def tokenize(text):
+    """
+    Identifier-aware tokenization. Every identifier is kept as a whole and additionally split into its
+    snake_case and CamelCase parts, e.g. "add_record_link" yields "add_record_link", "add", "record", "link".
+    """
+    tokens = []
+    for word in _WORD_PATTERN.findall(text):
+        lowered_word = word.lower()
+        tokens.append(lowered_word)
+
+        parts = [
+            part.lower()
+            for snake_part in word.split("_")
+            for part in _CAMEL_CASE_PATTERN.findall(snake_part)
+        ]
+        if len(parts) > 1 or (parts and parts[0] != lowered_word):
+            tokens.extend(parts)
+
+    return tokens
+
+
+class BM25Index:
+    """
+    Compact inverted index for lexical BM25 retrieval over the same chunks that are embedded into the vectorstore.
+    """
+
+    def __init__(self, documents, postings, document_lengths, k1=1.5, b=0.75):
+        """
+        Parameters:
+            documents (list): The indexed documents as dicts with "page_content" and "metadata".
+            postings (dict): Maps each term to a list of [document index, term frequency] pairs.
+            document_lengths (list): Number of tokens of each document.
+            k1 (float): BM25 term frequency saturation.
+            b (float): BM25 document length normalization.
+        """
+        self.documents = documents
+        self.postings = postings
+        self.document_lengths = document_lengths
+        self.k1 = k1
+        self.b = b
+
+        self.average_document_length = sum(document_lengths) / len(document_lengths) if document_lengths else 0.0
+        number_of_documents = len(documents)
+        self.idf = {
+            term: math.log(1 + (number_of_documents - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for term, term_postings in postings.items()
+        }
+
+    @classmethod
+    def from_documents(cls, documents, k1=1.5, b=0.75):
+        """Builds the index over langchain documents."""
+        stored_documents = []
+        postings = {}
+        document_lengths = []
+
+        for index, doc in enumerate(documents):
+            tokens = tokenize(doc.page_content)
+            stored_documents.append({"page_content": doc.page_content, "metadata": dict(doc.metadata)})
+            document_lengths.append(len(tokens))
+
+            for term, frequency in Counter(tokens).items():
+                postings.setdefault(term, []).append([index, frequency])
+
+        return cls(stored_documents, postings, document_lengths, k1, b)
+
+    def save(self, path):
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "k1": self.k1,
+                    "b": self.b,
+                    "documents": self.documents,
+                    "document_lengths": self.document_lengths,
+                    "postings": self.postings,
+                },
+                file,
+                separators=(",", ":"),
+            )
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            data = json.load(file)
+        return cls(data["documents"], data["postings"], data["document_lengths"], data["k1"], data["b"])
+
+    def search(self, query, k, filter=None):
+        """Returns the k best matching documents for the query that satisfy the metadata filter."""
+        return [document for document, _ in self.search_with_scores(query, k, filter)]
+
+    def search_with_scores(self, query, k, filter=None):
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+
+            for index, frequency in self.postings[term]:
+                length_normalization = 1 - self.b + self.b * self.document_lengths[index] / self.average_document_length
+                term_score = idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_normalization)
+                scores[index] = scores.get(index, 0.0) + term_score
+
+        candidates = (
+            (score, index) for index, score in scores.items()
+            if matches_filter(self.documents[index]["metadata"], filter)
+        )
+        return [
+            (Document(page_content=self.documents[index]["page_content"], metadata=dict(self.documents[index]["metadata"])), score)
+            for score, index in heapq.nlargest(k, candidates)
+        ]
+
+
+def reciprocal_rank_fusion(ranked_lists, k, rrf_k=60):
+    """
+    Fuses ranked lists of documents with reciprocal rank fusion and returns the k best documents.
+    Documents are identified by their source and content, so the same chunk found by several retrievers is merged.
+    """
+    fused_scores = {}
+    fused_documents = {}
+    for ranked_documents in ranked_lists:
+        for rank, doc in enumerate(ranked_documents, start=1):
+            key = (doc.metadata.get("source"), doc.page_content)
+            fused_scores[key] = fused_scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            fused_documents.setdefault(key, doc)
+
+    best_keys = sorted(fused_scores, key=fused_scores.get, reverse=True)[:k]
+    return [fused_documents[key] for key in best_keys]
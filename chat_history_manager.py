@@ -0,0 +1,186 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from token_counter import count_tokens, truncate_to_tokens
+
+
+class ChatHistoryManager:
+    """
+    Keeps the chat history in the prompt bounded in size.
+
+    The last max_verbatim_turns turns are included verbatim, all older turns are folded into a running
+    summary. The summary is updated incrementally: starting from the summary of the longest already
+    summarized prefix of the folded turns, the remaining turns are merged in one at a time. Summaries are
+    cached by the content of the folded turns, so concurrent chat sessions share one manager without keeping
+    per-session state. Without any cached prefix, e.g. after a restart, or with more than
+    max_incremental_turns turns left to merge, the folded turns are summarized at once in a single call,
+    dropping the oldest turns that do not fit into the token budget.
+    """
+
+    def __init__(self, llm, tokenizer, max_verbatim_turns=4, token_budget=3000, summary_token_budget=512, max_cached_summaries=256, max_incremental_turns=2):
+        """
+        Parameters:
+            llm: The LLM used to update the summaries.
+            tokenizer: The tokenizer used to measure the size of the formatted history.
+            max_verbatim_turns (int): Maximum number of most recent turns included verbatim.
+            token_budget (int): Maximum number of tokens of the formatted history.
+            summary_token_budget (int): Part of the token budget reserved for the summary.
+            max_cached_summaries (int): Number of summaries kept in memory.
+            max_incremental_turns (int): Maximum number of turns merged into a cached summary one LLM call
+                at a time, more turns are summarized from scratch in one call.
+        """
+        self.llm = llm
+        self.tokenizer = tokenizer
+        self.max_verbatim_turns = max_verbatim_turns
+        self.token_budget = token_budget
+        self.summary_token_budget = summary_token_budget
+        self.max_cached_summaries = max_cached_summaries
+        self.max_incremental_turns = max_incremental_turns
+
+        self._lock = threading.Lock()
+        self._summaries = OrderedDict()
+
+    def format_history(self, chat_history):
+        """Formats the chat history for the prompt, summarizing older turns with the LLM if necessary."""
+        split_index = self._split_index(chat_history)
+        folded_turns = chat_history[:split_index]
+
+        summary = ""
+        if folded_turns:
+            folded_count, summary = self._longest_cached_summary(folded_turns)
+            if summary is None or len(folded_turns) - folded_count > self.max_incremental_turns:
+                prompt = self._build_summary_prompt(folded_turns, None)
+                summary = self._store_summary(folded_turns, self.llm.invoke(prompt).content)
+            else:
+                for end in range(folded_count + 1, len(folded_turns) + 1):
+                    prompt = self._build_summary_prompt(folded_turns[:end], summary)
+                    summary = self._store_summary(folded_turns[:end], self.llm.invoke(prompt).content)
+
+        return self._format(summary, chat_history, split_index)
+
+    async def aformat_history(self, chat_history):
+        """Asynchronous variant of format_history."""
+        split_index = self._split_index(chat_history)
+        folded_turns = chat_history[:split_index]
+
+        summary = ""
+        if folded_turns:
+            folded_count, summary = self._longest_cached_summary(folded_turns)
+            if summary is None or len(folded_turns) - folded_count > self.max_incremental_turns:
+                response = await self.llm.ainvoke(self._build_summary_prompt(folded_turns, None))
+                summary = self._store_summary(folded_turns, response.content)
+            else:
+                for end in range(folded_count + 1, len(folded_turns) + 1):
+                    response = await self.llm.ainvoke(self._build_summary_prompt(folded_turns[:end], summary))
+                    summary = self._store_summary(folded_turns[:end], response.content)
+
+        return self._format(summary, chat_history, split_index)
+
+    def _split_index(self, chat_history):
+        """
+        Returns the index of the first turn included verbatim. Apart from the current turn, verbatim turns are
+        dropped from the oldest on until they fit into the token budget left next to the summary.
+        """
+        split_index = max(0, len(chat_history) - self.max_verbatim_turns)
+        verbatim_budget = self.token_budget - self.summary_token_budget
+
+        turn_tokens = [
+            count_tokens(format_turns([turn], start=1), self.tokenizer) for turn in chat_history[split_index:]
+        ]
+        total_tokens = sum(turn_tokens)
+
+        while split_index < len(chat_history) - 1 and total_tokens > verbatim_budget:
+            total_tokens -= turn_tokens.pop(0)
+            split_index += 1
+
+        return split_index
+
+    def _format(self, summary, chat_history, split_index):
+        verbatim_history = format_turns(chat_history[split_index:], start=split_index + 1)
+        if not summary:
+            return verbatim_history
+        return f"Summary of Turn 1 to {split_index}:\n{summary}\n\n{verbatim_history}"
+
+    def _build_summary_prompt(self, folded_turns, previous_summary):
+        if previous_summary is None:
+            return f"""Summarize the following conversation between a user and a Python programming assistant for the "Kadi-APY" library.
+                Keep the user's goals, the library methods, classes and parameters that were discussed and any decisions that were made.
+                Respond with only the summary in no more than 10 sentences.
+
+                Conversation:
+                {self._format_turns_within_budget(folded_turns)}
+            """
+
+        return f"""Update the summary of a conversation between a user and a Python programming assistant for the "Kadi-APY" library
+                with the new turn below. Keep the user's goals, the library methods, classes and parameters that were discussed and
+                any decisions that were made. Respond with only the updated summary in no more than 10 sentences.
+
+                Current summary:
+                {previous_summary}
+
+                New turn:
+                {format_turns(folded_turns[-1:], start=len(folded_turns))}
+            """
+
+    def _format_turns_within_budget(self, turns):
+        """Formats the turns for a summary from scratch, dropping the oldest turns beyond the token budget."""
+        turn_tokens = [count_tokens(format_turns([turn], start=1), self.tokenizer) for turn in turns]
+        start = 0
+        total_tokens = sum(turn_tokens)
+        while start < len(turns) - 1 and total_tokens > self.token_budget:
+            total_tokens -= turn_tokens[start]
+            start += 1
+
+        formatted_turns = format_turns(turns[start:], start=start + 1)
+        return truncate_to_tokens(formatted_turns, self.tokenizer, self.token_budget)
+
+    def _longest_cached_summary(self, folded_turns):
+        """Returns the number of turns of the longest prefix of the folded turns with a cached summary and the summary."""
+        keys = _prefix_keys(folded_turns)
+        with self._lock:
+            for length in range(len(keys), 0, -1):
+                summary = self._summaries.get(keys[length - 1])
+                if summary is not None:
+                    self._summaries.move_to_end(keys[length - 1])
+                    return length, summary
+        return 0, None
+
+    def _store_summary(self, folded_turns, summary):
+        summary = truncate_to_tokens(summary.strip(), self.tokenizer, self.summary_token_budget)
+
+        with self._lock:
+            self._summaries[_turns_key(folded_turns)] = summary
+            while len(self._summaries) > self.max_cached_summaries:
+                self._summaries.popitem(last=False)
+
+        return summary
+
+
+def format_turns(turns, start):
+    """Formats chat turns the same way KadiApyRagchain.format_history does, numbering them from start."""
+    formatted_history = []
+    for i, entry in enumerate(turns, start=start):
+        user_query = entry[0] if entry[0] is not None else "No query provided"
+        assistant_response = entry[1] if entry[1] is not None else "No response yet"
+
+        formatted_history.append(f"Turn {i}:")
+        formatted_history.append(f"User Query: {user_query}")
+        formatted_history.append(f"Assistant Response: {assistant_response}")
+        formatted_history.append("\n")
+
+    return "\n".join(formatted_history)
+
+
+def _turns_key(turns):
+    return _prefix_keys(turns)[-1] if turns else hashlib.sha256().hexdigest()
+
+
+def _prefix_keys(turns):
+    """Returns the cache keys of all non-empty prefixes of the turns, hashing every turn only once."""
+    digest = hashlib.sha256()
+    keys = []
+    for user_query, assistant_response in turns:
+        digest.update(f"{user_query}\0{assistant_response}\0".encode("utf-8"))
+        keys.append(digest.hexdigest())
+    return keys
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import logging
+import os
+
+from langchain.schema import Document
+
+
+class ChunkCache:
+    """
+    Persistent cache of the chunks of each source file, so files that did not change between releases
+    are not parsed and chunked again.
+
+    The key covers everything the chunks depend on: the chunker version, the chunking function, the file
+    path, the sha256 of the file content and the chunk size parameters. Each entry is a JSON file with
+    the serialized Documents, written as soon as the file is chunked.
+    """
+
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(chunker_version, function_name, file_content, file_path, *chunk_params):
+        content_hash = hashlib.sha256(file_content.encode("utf-8")).hexdigest()
+        # The length function of the chunk sizing is part of the parameters and is keyed by its repr
+        key_data = json.dumps([chunker_version, function_name, file_path, content_hash, *chunk_params], default=repr)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached chunks of the file or None."""
+        entry_path = self._entry_path(key)
+        if not os.path.exists(entry_path):
+            self.misses += 1
+            return None
+
+        with open(entry_path, "r") as file:
+            stored_documents = json.load(file)
+        self.hits += 1
+        return [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in stored_documents]
+
+    def add(self, key, documents):
+        temp_entry_path = self._entry_path(key) + ".tmp"
+        with open(temp_entry_path, "w") as file:
+            json.dump([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents], file)
+        os.replace(temp_entry_path, self._entry_path(key))
+
+    def log_stats(self):
+        logging.info(f"Chunk cache: {self.hits} of {self.hits + self.misses} files reused, {self.misses} chunked.")
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_directory, f"{key}.json")
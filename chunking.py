@@ -1,36 +1,173 @@
 import ast
+import hashlib
+import logging
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import repeat
 from langchain.schema import Document 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+import numpy as np
+
+from chunk_cache import ChunkCache
+
+# Part of the chunk cache keys, increase it whenever a change alters the chunks produced for the same file
+CHUNKER_VERSION = 3
+
+LENGTH_UNITS = ("characters", "tokens")
+
 # Split text into chunks
 
-def chunk_text_and_add_metadata(texts, references, chunk_size, chunk_overlap):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    chunks = []
+def chunk_text_and_add_metadata(texts, references, chunk_size, chunk_overlap, length_function=len):
+    return list(iter_text_chunks(texts, references, chunk_size, chunk_overlap, length_function=length_function))
 
-    for text, reference in zip(texts, references):
-        chunks.extend([
-            Document(
-                page_content=chunk,
-                metadata={
-                    "source": reference,
-                }
-            ) 
-            for chunk in text_splitter.split_text(text)
-        ])
-    return chunks
 
+def iter_text_chunks(texts, references, chunk_size, chunk_overlap, num_workers=1, chunk_cache=None, length_function=len):
+    """
+    Yields the chunks of the text files one file after another. With more than one worker the files
+    are split in a process pool, the chunks are still yielded in the order of the files. Files found
+    in the optional chunk cache are not split again. The chunk size is measured with length_function,
+    in characters by default or in tokens with a token_counter.TokenLength.
+    """
+    arguments = zip(texts, references, repeat(chunk_size), repeat(chunk_overlap), repeat(length_function))
+    for document_chunks in _map_in_order(_chunk_text_file, arguments, num_workers, chunk_cache):
+        yield from document_chunks
+
+
+def _chunk_text_file(text, reference, chunk_size, chunk_overlap, length_function=len):
+    # The start_index metadata records the character offset of each chunk in the file, the context packer
+    # uses it to put retrieved chunks back into their order in the file
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=length_function, add_start_index=True
+    )
+    return text_splitter.create_documents([text], metadatas=[{"source": reference}])
+
+
+def assign_chunk_ids(documents):
+    """Adds a deterministic chunk_id to the metadata of every chunk and returns the IDs, see iter_with_chunk_ids."""
+    return [doc.metadata["chunk_id"] for doc in iter_with_chunk_ids(documents)]
+
+
+def iter_with_chunk_ids(documents):
+    """
+    Adds a deterministic chunk_id to the metadata of every chunk and yields the chunks.
+
+    The ID is a hash of the source path, the symbol (class, method or command), the content hash and the
+    occurrence of that triple, so an unchanged chunk keeps its ID across releases and identical chunks
+    within the same symbol still get distinct IDs.
+    """
+    occurrences = Counter()
+    for doc in documents:
+        content_hash = hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()
+        symbol = "/".join(str(doc.metadata[key]) for key in ("class", "method", "command") if key in doc.metadata)
+        chunk_key = f"{doc.metadata.get('source')}\0{symbol}\0{content_hash}"
+
+        occurrence = occurrences[chunk_key]
+        occurrences[chunk_key] += 1
+
+        doc.metadata["chunk_id"] = hashlib.sha256(f"{chunk_key}\0{occurrence}".encode("utf-8")).hexdigest()[:32]
+        yield doc
+
+
+def chunk_pythoncode_and_add_metadata(code_files_content, code_files_path, max_chunk_size, length_function=len):
+    return list(iter_pythoncode_chunks(code_files_content, code_files_path, max_chunk_size, length_function=length_function))
+
+
+def iter_pythoncode_chunks(code_files_content, code_files_path, max_chunk_size, num_workers=1, chunk_cache=None, length_function=len):
+    """
+    Yields the chunks of the code files one file after another. With more than one worker the files
+    are parsed and chunked in a process pool, the chunks are still yielded in the order of the files.
+    Files found in the optional chunk cache are not parsed again. The chunk size is measured with
+    length_function, in characters by default or in tokens with a token_counter.TokenLength.
+    """
+    arguments = zip(code_files_content, code_files_path, repeat(max_chunk_size), repeat(length_function))
+    for document_chunks in _map_in_order(_generate_code_chunks_with_metadata, arguments, num_workers, chunk_cache):
+        yield from document_chunks
+
+
+class ChunkLengthStats:
+    """
+    Collects the lengths of the chunks passing through, measured by length_function, and logs their
+    distribution, how many chunks exceed max_length and would be truncated by the embedding model,
+    and how many are shorter than min_length and waste most of their slot in a batch.
+    """
+
+    def __init__(self, length_function, max_length=None, min_length=16):
+        self.length_function = length_function
+        self.max_length = max_length
+        self.min_length = min_length
+        self.lengths = []
+
+    def collect(self, documents):
+        for doc in documents:
+            self.lengths.append(self.length_function(doc.page_content))
+            yield doc
+
+    def log_stats(self, unit="tokens"):
+        if not self.lengths:
+            return
+
+        lengths = np.asarray(self.lengths)
+        p50, p90, p99 = np.percentile(lengths, [50, 90, 99])
+        message = (
+            f"Chunk lengths in {unit} over {len(lengths)} chunks: mean {lengths.mean():.0f}, p50 {p50:.0f}, "
+            f"p90 {p90:.0f}, p99 {p99:.0f}, max {lengths.max()}, {np.sum(lengths < self.min_length)} below {self.min_length}"
+        )
+        if self.max_length is not None:
+            message += f", {np.sum(lengths > self.max_length)} above the limit of {self.max_length} and truncated"
+        logging.info(message)
+
+
+def _map_in_order(function, arguments, num_workers, chunk_cache=None):
+    """
+    Yields function(file_content, file_path, *chunk_params) for each file in order. With more than one worker
+    the calls run in a process pool with at most two calls per worker ahead of the consumer, so a slow consumer
+    does not pile up results. Results found in the chunk cache are yielded without calling the function.
+    """
+    if num_workers <= 1:
+        for args in arguments:
+            yield _call_cached(function, args, chunk_cache)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+        for args in arguments:
+            key = ChunkCache.make_key(CHUNKER_VERSION, function.__name__, *args) if chunk_cache is not None else None
+            cached_documents = chunk_cache.get(key) if key is not None else None
+            if cached_documents is not None:
+                pending.append((None, cached_documents))
+            else:
+                pending.append((key, executor.submit(function, *args)))
+
+            while len(pending) >= 2 * num_workers:
+                yield _pop_result(pending, chunk_cache)
+        while pending:
+            yield _pop_result(pending, chunk_cache)
+
+
+def _call_cached(function, args, chunk_cache):
+    if chunk_cache is None:
+        return function(*args)
+
+    key = ChunkCache.make_key(CHUNKER_VERSION, function.__name__, *args)
+    documents = chunk_cache.get(key)
+    if documents is None:
+        documents = function(*args)
+        chunk_cache.add(key, documents)
+    return documents
 
-def chunk_pythoncode_and_add_metadata(code_files_content, code_files_path, max_chunk_size):
-    chunks = [] 
-    for code_file_content, code_file_path in zip(code_files_content, code_files_path):
-        document_chunks = _generate_code_chunks_with_metadata(code_file_content, code_file_path, max_chunk_size)
-        chunks.extend(document_chunks)   
-    return chunks
 
-def _generate_code_chunks_with_metadata(code_file_content, code_file_path, max_chunk_size):
+def _pop_result(pending, chunk_cache):
+    key, result = pending.popleft()
+    documents = result.result() if isinstance(result, Future) else result
+    if key is not None:
+        chunk_cache.add(key, documents)
+    return documents
+
+def _generate_code_chunks_with_metadata(code_file_content, code_file_path, max_chunk_size, length_function=len):
     documents = []
 
-    _iterate_ast(code_file_content, documents, code_file_path, max_chunk_size)
+    _iterate_ast(code_file_content, documents, code_file_path, max_chunk_size, length_function)
     usage = None
     if code_file_path.startswith("kadi_apy/lib/"):
         usage = "kadi_apy/lib/"
@@ -45,115 +182,112 @@ def _generate_code_chunks_with_metadata(code_file_content, code_file_path, max_c
 
     return documents
 
-def _iterate_ast(code_file_content, documents, code_file_path, max_chunk_size):
+
+class _SourceLines:
+    """
+    Line index of a code file, built once per file so every node handler slices its source out of it
+    instead of splitting the whole file again.
+    """
+
+    def __init__(self, code_file_content):
+        self.lines = code_file_content.splitlines()
+
+    def segment(self, start_line, end_line):
+        """Returns the source of the 1-based, inclusive line range."""
+        return '\n'.join(self.lines[start_line-1:end_line])
+
+
+def _iterate_ast(code_file_content, documents, code_file_path, max_chunk_size, length_function=len):
     tree = ast.parse(code_file_content, filename=code_file_path)
     first_level_nodes = list(ast.iter_child_nodes(tree))
 
     if not first_level_nodes:
         documents.extend(
-            _chunk_nodeless_code_file_content(code_file_content, code_file_path, max_chunk_size))
+            _chunk_nodeless_code_file_content(code_file_content, code_file_path, max_chunk_size, length_function))
         return
 
     all_imports = all(isinstance(node, (ast.Import, ast.ImportFrom)) for node in first_level_nodes)
 
     if all_imports:
         documents.extend(
-            _chunk_import_only_code_file_content(code_file_content, code_file_path, max_chunk_size)
+            _chunk_import_only_code_file_content(code_file_content, code_file_path, max_chunk_size, length_function)
         )
     else:
-        for first_level_node in ast.iter_child_nodes(tree):
+        source_lines = _SourceLines(code_file_content)
+        for first_level_node in first_level_nodes:
             if isinstance(first_level_node, ast.ClassDef):
                 documents.extend(
-                    _handle_first_level_class(first_level_node, code_file_content, max_chunk_size)
+                    _handle_first_level_class(first_level_node, source_lines, max_chunk_size, length_function)
                 )
-            elif isinstance(first_level_node, ast.FunctionDef):
+            elif isinstance(first_level_node, (ast.FunctionDef, ast.AsyncFunctionDef)):
                 documents.extend(
-                    _chunk_first_level_func_node(first_level_node, code_file_content, max_chunk_size)
+                    _chunk_first_level_func_node(first_level_node, source_lines, max_chunk_size, length_function)
                 )
             elif isinstance(first_level_node, ast.Assign):
                 documents.extend(
-                    _chunk_first_level_assign_node(first_level_node, code_file_content, max_chunk_size)
+                    _chunk_first_level_assign_node(first_level_node, source_lines, max_chunk_size, length_function)
                 )
             else:
                 if not isinstance(first_level_node, (ast.Import, ast.ImportFrom)):
                     documents.extend(
-                        _handle_not_defined_case(first_level_node, code_file_content, max_chunk_size)
+                        _handle_not_defined_case(first_level_node, source_lines, max_chunk_size, length_function)
                     )
 
-def _handle_first_level_class(ast_node, code_file_content, max_chunk_size):
-    documents = []
+def _handle_first_level_class(ast_node, source_lines, max_chunk_size, length_function=len, class_name=None):
+    """
+    Chunks the class header, i.e. everything up to its first method or nested class, and each method.
+    Nested classes are chunked the same way, named by their dotted path such as "Outer.Inner".
+    """
+    class_name = class_name or ast_node.name
     class_start_line = ast_node.lineno
-    class_body_lines = [child.lineno for child in ast_node.body if isinstance(child, ast.FunctionDef)]
+    class_body_lines = [
+        child.lineno for child in ast_node.body
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+    ]
     class_end_line = min(class_body_lines, default=ast_node.end_lineno) - 1
-    class_source = '\n'.join(code_file_content.splitlines()[class_start_line-1:class_end_line])
+    class_source = source_lines.segment(class_start_line, class_end_line)
 
     metadata = {
         "type": "class",
-        "class": ast_node.name,
+        "class": class_name,
         "visibility": "public"
     }
-
-    if len(class_source) > max_chunk_size:
-        class_chunks = _split_into_chunks(class_source, max_chunk_size)
-        for chunk in class_chunks:
-            doc = Document(
-                page_content=chunk,
-                metadata=metadata
-            )
-            documents.append(doc)
-    else:
-        doc = Document(
-            page_content=class_source,
-            metadata=metadata
-        )
-        documents.append(doc)
+    documents = _create_documents(class_source, metadata, max_chunk_size, length_function, class_start_line)
 
     for second_level_node in ast.iter_child_nodes(ast_node):
-        if isinstance(second_level_node, ast.FunctionDef):
+        if isinstance(second_level_node, (ast.FunctionDef, ast.AsyncFunctionDef)):
             method_start_line = (
                 second_level_node.decorator_list[0].lineno
                 if second_level_node.decorator_list else second_level_node.lineno
             )
             method_end_line = second_level_node.end_lineno
-            method_source = '\n'.join(code_file_content.splitlines()[method_start_line-1:method_end_line])
+            method_source = source_lines.segment(method_start_line, method_end_line)
 
             visibility = "internal" if second_level_node.name.startswith("_") else "public"
 
-            if len(method_source) > max_chunk_size:
-                method_chunks = _split_into_chunks(method_source, max_chunk_size)
-                for chunk in method_chunks:
-                    doc = Document(
-                        page_content=chunk,
-                        metadata={
-                            "type": "method",
-                            "method": second_level_node.name,
-                            "visibility": visibility,
-                            "class": ast_node.name
-                        }
-                    )
-                    documents.append(doc)
-            else:
-                doc = Document(
-                    page_content=method_source,
-                    metadata={
-                        "type": "method",
-                        "method": second_level_node.name,
-                        "visibility": visibility,
-                        "class": ast_node.name
-                    }
-                )
-                documents.append(doc)
+            metadata = {
+                "type": "method",
+                "method": second_level_node.name,
+                "visibility": visibility,
+                "class": class_name
+            }
+            documents.extend(
+                _create_documents(method_source, metadata, max_chunk_size, length_function, method_start_line)
+            )
+        elif isinstance(second_level_node, ast.ClassDef):
+            documents.extend(
+                _handle_first_level_class(second_level_node, source_lines, max_chunk_size, length_function, f"{class_name}.{second_level_node.name}")
+            )
 
     return documents
 
-def _chunk_first_level_func_node(ast_node, code_file_content, max_chunk_size):
-    documents = []
+def _chunk_first_level_func_node(ast_node, source_lines, max_chunk_size, length_function=len):
     function_start_line = (
         ast_node.decorator_list[0].lineno
         if ast_node.decorator_list else ast_node.lineno
     )
     function_end_line = ast_node.end_lineno
-    function_source = '\n'.join(code_file_content.splitlines()[function_start_line-1:function_end_line])
+    function_source = source_lines.segment(function_start_line, function_end_line)
 
     visibility = "internal" if ast_node.name.startswith("_") else "public"
 
@@ -172,160 +306,85 @@ def _chunk_first_level_func_node(ast_node, code_file_content, max_chunk_size):
     else:
         metadata["method"] = ast_node.name
 
-    if len(function_source) > max_chunk_size:
-        function_chunks = _split_into_chunks(function_source, max_chunk_size)
-        for chunk in function_chunks:
-            doc = Document(
-                page_content=chunk,
-                metadata=metadata
-            )
-            documents.append(doc)
-    else:
-        doc = Document(
-            page_content=function_source,
-            metadata=metadata
-        )
-        documents.append(doc)
+    return _create_documents(function_source, metadata, max_chunk_size, length_function, function_start_line)
 
-    return documents
-
-def _chunk_first_level_assign_node(ast_node, code_file_content, max_chunk_size):
+def _chunk_first_level_assign_node(ast_node, source_lines, max_chunk_size, length_function=len):
     """
     Handles assignment statements at the first level of the AST.
     """
-    documents = []
-    assign_start_line = ast_node.lineno
-    assign_end_line = ast_node.end_lineno
-    assign_source = '\n'.join(code_file_content.splitlines()[assign_start_line-1:assign_end_line])
-
-    metadata = {"type": "Assign"}
-
-    if len(assign_source) > max_chunk_size:
-        assign_chunks = _split_into_chunks(assign_source, max_chunk_size)
-        for chunk in assign_chunks:
-            doc = Document(
-                page_content=chunk,
-                metadata=metadata
-            )
-            documents.append(doc)
-    else:
-        doc = Document(
-            page_content=assign_source,
-            metadata=metadata
-        )
-        documents.append(doc)
+    assign_source = source_lines.segment(ast_node.lineno, ast_node.end_lineno)
+    return _create_documents(assign_source, {"type": "Assign"}, max_chunk_size, length_function, ast_node.lineno)
 
-    return documents
-
-def _chunk_import_only_code_file_content(code_file_content, code_file_path, max_chunk_size):
+def _chunk_import_only_code_file_content(code_file_content, code_file_path, max_chunk_size, length_function=len):
     """
     Handles cases where the first-level nodes are only imports.
     """
-    documents = []
     if code_file_path.endswith("__init__.py"):
         type = "__init__-file"
     else:
         type = "undefined"
 
-    metadata = {"type": type}
+    return _create_documents(code_file_content, {"type": type}, max_chunk_size, length_function)
 
-    if len(code_file_content) > max_chunk_size:
-        import_chunks = _split_into_chunks(code_file_content, max_chunk_size)
-        for chunk in import_chunks:
-            doc = Document(
-                page_content=chunk,
-                metadata=metadata
-            )
-            documents.append(doc)
-    else:
-        doc = Document(
-            page_content=code_file_content,
-            metadata=metadata
-        )
-        documents.append(doc)
-
-    return documents
-
-def _chunk_nodeless_code_file_content(code_file_content, code_file_path, max_chunk_size):
+def _chunk_nodeless_code_file_content(code_file_content, code_file_path, max_chunk_size, length_function=len):
     """
     Handles cases where no top-level nodes are found in the AST.
     """
-    documents = []
     if code_file_path.endswith("__init__.py"):
         type = "__init__-file"
     else:
         type = "undefined"
 
-    metadata = {"type": type}
-
-    if len(code_file_content) > max_chunk_size:
-        nodeless_chunks = _split_into_chunks(code_file_content, max_chunk_size)
-        for chunk in nodeless_chunks:
-            doc = Document(
-                page_content=chunk,
-                metadata=metadata
-            )
-            documents.append(doc)
-    else:
-        doc = Document(
-            page_content=code_file_content,
-            metadata=metadata
-        )
-        documents.append(doc)
+    return _create_documents(code_file_content, {"type": type}, max_chunk_size, length_function)
 
-    return documents
-
-def _handle_not_defined_case(ast_node, code_file_content, max_chunk_size):
+def _handle_not_defined_case(ast_node, source_lines, max_chunk_size, length_function=len):
     """
     Captures all lines corresponding to the given node and creates
     a Document with metadata for undefined type.
     """
-    documents = []
-    # Determine the start and end lines of the node
-    start_line = ast_node.lineno
-    end_line = ast_node.end_lineno
-
-    # Extract the relevant lines from the code file content
-    lines = code_file_content.splitlines()
-    undefined_content = "\n".join(lines[start_line - 1:end_line])
-
-    metadata = {"type": "undefined"}
-
-    if len(undefined_content) > max_chunk_size:
-        undefined_chunks = _split_into_chunks(undefined_content, max_chunk_size)
-        for chunk in undefined_chunks:
-            doc = Document(
-                page_content=chunk,
-                metadata=metadata
-            )
-            documents.append(doc)
+    undefined_content = source_lines.segment(ast_node.lineno, ast_node.end_lineno)
+    return _create_documents(undefined_content, {"type": "undefined"}, max_chunk_size, length_function, ast_node.lineno)
+
+
+def _create_documents(source, metadata, max_chunk_size, length_function=len, start_line=1):
+    """
+    Creates one Document for the source, or one per piece if it exceeds max_chunk_size as measured by
+    length_function. Every Document gets its own copy of the metadata, with the line number of its first
+    line in the file as start_line, given the source starts at start_line.
+    """
+    if length_function(source) > max_chunk_size:
+        chunks = _split_into_chunks(source, max_chunk_size, length_function)
     else:
-        doc = Document(
-            page_content=undefined_content,
-            metadata=metadata
-        )
-        documents.append(doc)
+        chunks = [(0, source)]
 
-    return documents
+    return [
+        Document(page_content=chunk, metadata={**metadata, "start_line": start_line + line_offset})
+        for line_offset, chunk in chunks
+    ]
 
 
-def _split_into_chunks(source, max_chunk_size):
-    """Splits source content into smaller chunks of max_chunk_size."""
+def _split_into_chunks(source, max_chunk_size, length_function=len):
+    """
+    Splits source content at line boundaries into smaller chunks of max_chunk_size, measured by length_function.
+    Returns (line offset, chunk) pairs, the line offset being the index of the first line of the chunk in source.
+    """
     lines = source.splitlines()
     chunks = []
     current_chunk = []
+    current_offset = 0
     current_size = 0
 
-    for line in lines:
-        line_size = len(line) + 1  # Add 1 for the newline character
+    for line_index, line in enumerate(lines):
+        line_size = length_function(line) + 1  # Add 1 for the newline character, which is also one token
         if current_size + line_size > max_chunk_size:
-            chunks.append('\n'.join(current_chunk))
+            chunks.append((current_offset, '\n'.join(current_chunk)))
             current_chunk = []
+            current_offset = line_index
             current_size = 0
         current_chunk.append(line)
         current_size += line_size
 
     if current_chunk:
-        chunks.append('\n'.join(current_chunk))
+        chunks.append((current_offset, '\n'.join(current_chunk)))
 
     return chunks
@@ -10,4 +10,14 @@ def load_config(config_path):
         try:
             return json.load(file)
         except json.JSONDecodeError as e:
-            raise ValueError(f"Error parsing JSON: {e}")
\ No newline at end of file
+            raise ValueError(f"Error parsing JSON: {e}")
+
+
+def get_vectorstore_version(update_history_path):
+    """Returns an identifier of the deployed vectorstore, taken from the latest entry of the update history."""
+    history = load_config(update_history_path)["update_history"]
+    if not history:
+        return None
+
+    latest_entry = history[0]
+    return f"{latest_entry['project_release_version']}@{latest_entry['update_date']}"
@@ -0,0 +1,198 @@
+import re
+
+from langchain.schema import Document
+
+from token_counter import count_tokens, truncate_to_tokens
+
+_WORD_PATTERN = re.compile(r"\w+")
+# Upper bound of the whitespace stripped between two consecutive documentation chunks, in characters
+_MAX_STRIPPED_WHITESPACE = 2
+
+
+class ContextPacker:
+    """
+    Packs retrieved chunks into the prompt context within a token budget.
+
+    Near-duplicate chunks are dropped. The remaining chunks of the same class header, the same function, method
+    or command, or the same documentation file are put back into their order in the file, using the start_line
+    or start_index recorded at chunk time, and adjacent pieces are merged into one snippet. The snippets are
+    added in retrieval order, i.e. by the best score of their pieces, as long as they fit into the token budget.
+    A class header snippet is moved right before the first snippet of a method of its class.
+    """
+
+    def __init__(self, tokenizer, doc_token_budget=1024, code_token_budget=2048, duplicate_threshold=0.8, shingle_size=3):
+        """
+        Parameters:
+            tokenizer: The tokenizer of the LLM, used to measure the snippets.
+            doc_token_budget (int): Token budget for the documentation snippets.
+            code_token_budget (int): Token budget for the code snippets.
+            duplicate_threshold (float): Jaccard similarity of word shingles above which a chunk counts as near-duplicate.
+            shingle_size (int): Number of words per shingle.
+        """
+        self.tokenizer = tokenizer
+        self.doc_token_budget = doc_token_budget
+        self.code_token_budget = code_token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.shingle_size = shingle_size
+
+    def pack(self, documents, token_budget):
+        """
+        Returns the merged, deduplicated snippets that fit into the token budget, ordered by their best retrieval rank.
+        """
+        groups = {}
+        seen_shingles = []
+
+        for rank, doc in enumerate(documents):
+            shingles = self._shingles(doc.page_content)
+            if any(_jaccard(shingles, other) >= self.duplicate_threshold for other in seen_shingles):
+                continue
+            seen_shingles.append(shingles)
+
+            groups.setdefault(_group_key(doc), []).append((rank, doc))
+
+        snippets = []
+        for group in groups.values():
+            snippets.extend(_merge_adjacent(group))
+
+        packed_documents = []
+        used_tokens = 0
+        for merged_doc in _order_snippets(snippets):
+            tokens = count_tokens(merged_doc.page_content, self.tokenizer)
+
+            if used_tokens + tokens <= token_budget:
+                packed_documents.append(merged_doc)
+                used_tokens += tokens
+            elif not packed_documents:
+                # The best snippet alone exceeds the budget, so it is cut instead of leaving the context empty
+                merged_doc.page_content = truncate_to_tokens(merged_doc.page_content, self.tokenizer, token_budget)
+                packed_documents.append(merged_doc)
+                used_tokens = token_budget
+
+        return packed_documents
+
+    def _shingles(self, text):
+        words = _WORD_PATTERN.findall(text.lower())
+        if len(words) <= self.shingle_size:
+            return {tuple(words)}
+        return {tuple(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+
+def _group_key(doc):
+    metadata = doc.metadata
+    source = metadata.get("source")
+    if "class" in metadata:
+        # The header and each method of a class are separate groups, the method is None for the header
+        return (source, "class", metadata["class"], metadata.get("method"))
+    if "command" in metadata:
+        return (source, "command", metadata["command"])
+    if "method" in metadata:
+        return (source, "method", metadata["method"])
+    if metadata.get("dataset_category") == "kadi_apy_docs":
+        return (source, "docs", None)
+    # Chunks without symbol, e.g. assignments or undefined code, are not merged
+    return (source, "chunk", id(doc))
+
+
+def _merge_adjacent(group):
+    """
+    Sorts the (rank, doc) pairs of a group by their position in the file and merges the runs of adjacent or
+    overlapping pieces. Returns (rank, doc) pairs, the rank of a merged snippet being the best of its pieces.
+    Pieces without a recorded position, e.g. from a vectorstore built before positions were recorded,
+    stay separate snippets.
+    """
+    positioned = [(rank, doc) for rank, doc in group if _span(doc) is not None]
+    snippets = [(rank, _copy(doc)) for rank, doc in group if _span(doc) is None]
+
+    positioned.sort(key=lambda pair: _span(pair[1]))
+    run = []
+    for rank, doc in positioned:
+        if run and _span(doc)[0] > _span(run[-1][1])[1]:
+            snippets.append(_merge_run(run))
+            run = []
+        run.append((rank, doc))
+    if run:
+        snippets.append(_merge_run(run))
+
+    return snippets
+
+
+def _merge_run(run):
+    if len(run) == 1:
+        rank, doc = run[0]
+        return rank, _copy(doc)
+
+    first_doc = run[0][1]
+    page_content = first_doc.page_content
+    end = _span(first_doc)[1]
+    for _, doc in run[1:]:
+        start, doc_end = _span(doc)
+        if doc_end <= end:
+            # The piece is contained in the snippet so far
+            continue
+        page_content = _append_piece(page_content, doc, end - start)
+        end = doc_end
+
+    metadata = dict(first_doc.metadata)
+    metadata["merged_chunks"] = len(run)
+    return min(rank for rank, _ in run), Document(page_content=page_content, metadata=metadata)
+
+
+def _span(doc):
+    """
+    Returns the [start, end) range of the piece in its file, in lines for code and in characters for
+    documentation, or None if no position was recorded.
+    """
+    metadata = doc.metadata
+    if "start_line" in metadata:
+        return metadata["start_line"], metadata["start_line"] + doc.page_content.count("\n") + 1
+    if "start_index" in metadata:
+        # The splitter strips the whitespace between chunks, which counts as adjacent
+        return metadata["start_index"], metadata["start_index"] + len(doc.page_content) + _MAX_STRIPPED_WHITESPACE
+    return None
+
+
+def _append_piece(page_content, doc, overlap):
+    """Appends the piece to the snippet, dropping the first overlap lines or characters it shares with the snippet."""
+    if "start_line" in doc.metadata:
+        return page_content + "\n" + "\n".join(doc.page_content.split("\n")[overlap:])
+
+    overlap -= _MAX_STRIPPED_WHITESPACE
+    if overlap > 0 and page_content.endswith(doc.page_content[:overlap]):
+        return page_content + doc.page_content[overlap:]
+    return page_content + "\n" + doc.page_content
+
+
+def _order_snippets(snippets):
+    """
+    Orders the (rank, doc) snippets by rank, except that a class header goes right before the best ranked
+    snippet of its class if that comes first.
+    """
+    class_ranks = {}
+    for rank, doc in snippets:
+        class_key = _class_key(doc)
+        if class_key is not None:
+            class_ranks[class_key] = min(rank, class_ranks.get(class_key, rank))
+
+    def sort_key(snippet):
+        rank, doc = snippet
+        if doc.metadata.get("type") == "class":
+            return class_ranks[_class_key(doc)], 0
+        return rank, 1
+
+    return [doc for _, doc in sorted(snippets, key=sort_key)]
+
+
+def _class_key(doc):
+    if "class" not in doc.metadata:
+        return None
+    return doc.metadata.get("source"), doc.metadata["class"]
+
+
+def _copy(doc):
+    return Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+
+
+def _jaccard(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of document embeddings keyed by (model name, model revision, sha256 of the content).
+
+    Each model name, revision and inference backend gets its own directory with a memory-mappable vectors.npy
+    file holding one row per cached embedding and a keys.json file mapping the content hashes to their rows.
+    """
+
+    def __init__(self, cache_directory, model_name, model_revision, backend="fp32"):
+        self.model_name = model_name
+        self.model_revision = model_revision
+        self.backend = backend
+
+        model_key = hashlib.sha256(f"{model_name}@{model_revision}:{backend}".encode("utf-8")).hexdigest()[:16]
+        self.directory = os.path.join(cache_directory, model_key)
+        self.vectors_path = os.path.join(self.directory, "vectors.npy")
+        self.keys_path = os.path.join(self.directory, "keys.json")
+
+        self._rows = {}
+        self._vectors = None
+        self._new_keys = []
+        self._new_vectors = []
+
+        if os.path.exists(self.vectors_path) and os.path.exists(self.keys_path):
+            with open(self.keys_path, "r") as file:
+                self._rows = json.load(file)["rows"]
+            self._vectors = np.load(self.vectors_path, mmap_mode="r")
+
+    @staticmethod
+    def content_key(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached embedding for the content hash or None."""
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        if row < 0:
+            return self._new_vectors[-row - 1]
+        return np.asarray(self._vectors[row], dtype=np.float32).tolist()
+
+    def add(self, key, embedding):
+        """Adds an embedding, it is written to disk with the next call of save."""
+        if key in self._rows:
+            return
+        self._new_keys.append(key)
+        self._new_vectors.append(list(embedding))
+        # Negative rows point into the embeddings that are not saved yet
+        self._rows[key] = -len(self._new_vectors)
+
+    def save(self):
+        """Appends the new embeddings to the vectors file and writes the key index."""
+        if not self._new_vectors:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        new_vectors = np.asarray(self._new_vectors, dtype=np.float32)
+        vectors = new_vectors if self._vectors is None else np.concatenate([self._vectors, new_vectors])
+        offset = 0 if self._vectors is None else len(self._vectors)
+
+        for index, key in enumerate(self._new_keys):
+            self._rows[key] = offset + index
+
+        temp_vectors_path = self.vectors_path + ".tmp"
+        with open(temp_vectors_path, "wb") as file:
+            np.save(file, vectors)
+        os.replace(temp_vectors_path, self.vectors_path)
+
+        temp_keys_path = self.keys_path + ".tmp"
+        with open(temp_keys_path, "w") as file:
+            json.dump(
+                {"model_name": self.model_name, "model_revision": self.model_revision, "backend": self.backend, "rows": self._rows},
+                file,
+            )
+        os.replace(temp_keys_path, self.keys_path)
+
+        self._vectors = np.load(self.vectors_path, mmap_mode="r")
+        self._new_keys = []
+        self._new_vectors = []
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedding model wrapper that only embeds documents whose content is not in the embedding cache yet.
+    Queries are passed through to the wrapped model.
+    """
+
+    def __init__(self, embedding_model, cache):
+        self.embedding_model = embedding_model
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        keys = [self.cache.content_key(text) for text in texts]
+        embeddings = [self.cache.get(key) for key in keys]
+
+        missing_indices = [index for index, embedding in enumerate(embeddings) if embedding is None]
+        # Identical contents within the batch are embedded only once
+        missing_texts = {keys[index]: texts[index] for index in missing_indices}
+        if missing_texts:
+            new_embeddings = self.embedding_model.embed_documents(list(missing_texts.values()))
+            for key, embedding in zip(missing_texts, new_embeddings):
+                self.cache.add(key, embedding)
+            for index in missing_indices:
+                embeddings[index] = self.cache.get(keys[index])
+
+        self.hits += len(texts) - len(missing_indices)
+        self.misses += len(missing_indices)
+        return embeddings
+
+    def embed_query(self, text):
+        return self.embedding_model.embed_query(text)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def log_stats(self):
+        logging.info(
+            f"Embedding cache: {self.hits} hits, {self.misses} misses, hit rate {self.hit_rate():.2%}, "
+            f"{len(self.cache)} cached embeddings."
+        )
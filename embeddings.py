@@ -1,4 +1,12 @@
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
+from huggingface_hub import HfApi
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+import threading
+import time
 import torch
 
 
@@ -14,18 +22,222 @@ def get_hf_embedding_model(model_name=None):
     return embeddings
 
 
+EMBEDDING_BACKENDS = ("fp32", "int8")
+
+
 def get_SFR_Code_embedding_model(
-    model_name="Salesforce/SFR-Embedding-Code-400M_R", device="auto"
+    model_name="Salesforce/SFR-Embedding-Code-400M_R", device="auto", revision=None, backend="fp32"
 ):
+    """
+    Load the SFR-Code embedding model. The "int8" backend applies dynamic int8 quantization to the linear
+    layers of the encoder for faster CPU inference; index and queries must be embedded with the same backend.
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}, expected one of {EMBEDDING_BACKENDS}")
 
     if device == "auto":
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = "cuda" if torch.cuda.is_available() and backend == "fp32" else "cpu"
+    if backend == "int8" and device != "cpu":
+        raise ValueError("The int8 embedding backend is only supported on CPU.")
 
     model_name = model_name
     model_kwargs = {"device": device, "trust_remote_code": True}
+    if revision is not None:
+        model_kwargs["revision"] = revision
     embeddings = HuggingFaceEmbeddings(
         model_name=model_name,
         model_kwargs=model_kwargs,
     )
 
-    return embeddings
\ No newline at end of file
+    if backend == "int8":
+        # Only the weights of the linear layers are quantized ahead of time, activations are quantized on the fly
+        torch.ao.quantization.quantize_dynamic(embeddings._client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    return embeddings
+
+
+def resolve_model_revision(model_name, revision=None):
+    """Resolves a branch or tag of a Hugging Face model to its commit hash, falling back to the given revision."""
+    try:
+        return HfApi().model_info(model_name, revision=revision).sha
+    except Exception as e:
+        logging.warning(f"Could not resolve the revision of {model_name}: {e}")
+        return revision or "main"
+
+
+class QueryEmbeddingCache:
+    """
+    Embeds queries with an LRU cache of recently embedded queries in front of the embedding model.
+    All queries missing from the cache are embedded together in a single embed_documents call, which
+    matches embed_query as long as the model uses the same encode arguments for queries and documents.
+    """
+
+    def __init__(self, embedding_model, max_entries=1024):
+        self.embedding_model = embedding_model
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._embeddings = OrderedDict()
+
+    def embed_queries(self, queries):
+        """Returns the embeddings of the queries in the same order."""
+        embeddings = {}
+        with self._lock:
+            for query in queries:
+                if query in self._embeddings:
+                    self._embeddings.move_to_end(query)
+                    embeddings[query] = self._embeddings[query]
+
+        missing_queries = list(dict.fromkeys(query for query in queries if query not in embeddings))
+        if missing_queries:
+            new_embeddings = self.embedding_model.embed_documents(missing_queries)
+            embeddings.update(zip(missing_queries, new_embeddings))
+
+            with self._lock:
+                for query, embedding in zip(missing_queries, new_embeddings):
+                    self._embeddings[query] = embedding
+                while len(self._embeddings) > self.max_entries:
+                    self._embeddings.popitem(last=False)
+
+        return [embeddings[query] for query in queries]
+
+    def embed_query(self, query):
+        return self.embed_queries([query])[0]
+
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    Embedding model wrapper for index builds that sorts the documents by token length and embeds them in batches
+    of similar length, so little compute is spent on padding. The embeddings are returned in the original order.
+    """
+
+    def __init__(self, embedding_model, tokenizer=None, batch_size=32, max_batch_tokens=None):
+        """
+        Parameters:
+            embedding_model: The wrapped embedding model.
+            tokenizer: The tokenizer of the embedding model, used to sort by token length. Without it the
+                documents are sorted by character length.
+            batch_size (int): Maximum number of documents per batch.
+            max_batch_tokens (int): Maximum number of padded tokens per batch, i.e. batch size times the
+                length of its longest document. None only limits the batch size.
+        """
+        self.embedding_model = embedding_model
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+
+        start_time = time.perf_counter()
+        lengths = self._lengths(texts)
+        embeddings = [None] * len(texts)
+
+        buckets = list(self._length_buckets(lengths))
+        batches_embeddings = self._embed_batches([[texts[index] for index in batch_indices] for batch_indices in buckets])
+
+        padded_tokens = 0
+        for batch_indices, batch_embeddings in zip(buckets, batches_embeddings):
+            for index, embedding in zip(batch_indices, batch_embeddings):
+                embeddings[index] = embedding
+            padded_tokens += len(batch_indices) * max(lengths[index] for index in batch_indices)
+
+        elapsed_time = time.perf_counter() - start_time
+        logging.info(
+            f"Embedded {len(texts)} documents in {elapsed_time:.1f}s ({len(texts) / elapsed_time:.1f} docs/sec), "
+            f"padding efficiency {sum(lengths) / max(padded_tokens, 1):.2%}."
+        )
+        return embeddings
+
+    def embed_query(self, text):
+        return self.embedding_model.embed_query(text)
+
+    def _embed_batches(self, batches):
+        """Embeds the batches one after another, returning the embeddings per batch."""
+        return [self.embedding_model.embed_documents(batch) for batch in batches]
+
+    def _lengths(self, texts):
+        if self.tokenizer is None:
+            return [len(text) for text in texts]
+        return [len(token_ids) for token_ids in self.tokenizer(texts, add_special_tokens=True)["input_ids"]]
+
+    def _length_buckets(self, lengths):
+        """Yields the indices of the documents per batch, from the shortest to the longest documents."""
+        batch = []
+        for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+            # Sorted ascending, so the current document is the longest one of the batch
+            exceeds_tokens = (
+                self.max_batch_tokens is not None
+                and batch
+                and (len(batch) + 1) * lengths[index] > self.max_batch_tokens
+            )
+            if len(batch) == self.batch_size or exceeds_tokens:
+                yield batch
+                batch = []
+            batch.append(index)
+
+        if batch:
+            yield batch
+
+
+
+class ParallelEmbeddings(BatchedEmbeddings):
+    """
+    Length-bucketed embedding for index builds that spreads the batches across a pool of worker processes,
+    each holding its own replica of the SFR-Code embedding model. The batches do not depend on the number of
+    workers and the results are collected in submission order, so the output is deterministic and ordered.
+    """
+
+    def __init__(self, model_name, revision=None, backend="fp32", num_workers=2, torch_threads_per_worker=1, device="cpu", tokenizer=None, batch_size=32, max_batch_tokens=None):
+        """
+        Parameters:
+            model_name (str): The embedding model loaded in every worker.
+            revision (str): The revision of the embedding model.
+            backend (str): The inference backend of the embedding model, see get_SFR_Code_embedding_model.
+            num_workers (int): Number of worker processes.
+            torch_threads_per_worker (int): Number of torch intra-op threads per worker.
+            device (str): The device of the model replicas.
+            tokenizer, batch_size, max_batch_tokens: See BatchedEmbeddings.
+        """
+        super().__init__(None, tokenizer=tokenizer, batch_size=batch_size, max_batch_tokens=max_batch_tokens)
+        self.num_workers = num_workers
+
+        # Forked workers would inherit the torch state of the parent process, so they are spawned instead
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_embedding_worker,
+            initargs=(model_name, revision, backend, device, torch_threads_per_worker),
+        )
+
+    def embed_query(self, text):
+        return self._executor.submit(_embed_batch_in_worker, [text]).result()[0]
+
+    def _embed_batches(self, batches):
+        return list(self._executor.map(_embed_batch_in_worker, batches))
+
+    def close(self):
+        """Shuts down the worker processes."""
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_worker_embedding_model = None
+
+
+def _init_embedding_worker(model_name, revision, backend, device, torch_threads):
+    global _worker_embedding_model
+
+    torch.set_num_threads(torch_threads)
+    _worker_embedding_model = get_SFR_Code_embedding_model(model_name, device=device, revision=revision, backend=backend)
+
+
+def _embed_batch_in_worker(texts):
+    return _worker_embedding_model.embed_documents(texts)
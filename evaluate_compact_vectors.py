@@ -0,0 +1,80 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from config_loader import load_config
+from embeddings import get_SFR_Code_embedding_model
+from retrieval_evaluation import top_k_indices, recall_at_k
+from vectorstore import get_vectorstore, compact_vectors, FlatVectorStore
+from vectorstore_manifest import read_manifest
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+vectorstore_path = "data/vectorstore"
+evaluation_queries_path = "config_files/evaluation_queries.json"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare reduced-dimension and float16 vectors with the full-precision index.")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[1024, 768, 512, 256])
+    parser.add_argument("--min-recall", type=float, default=0.9)
+    args = parser.parse_args()
+
+    manifest = read_manifest(vectorstore_path)
+    if manifest.get("vector_dimension") is not None or manifest.get("vector_dtype", "float32") != "float32":
+        logging.error("The reference vectorstore has to be built with full-dimension float32 vectors.")
+        sys.exit(1)
+
+    model_name = manifest.get("embedding_model", "Salesforce/SFR-Embedding-Code-400M_R")
+    embedding_model = get_SFR_Code_embedding_model(
+        model_name, revision=manifest.get("embedding_model_revision"), backend=manifest.get("embedding_backend", "fp32")
+    )
+    queries = load_config(evaluation_queries_path)["queries"]
+
+    stored_data = get_vectorstore(embedding_model, vectorstore_path, "flat").get(include=["embeddings"])
+    corpus = np.asarray(stored_data["embeddings"], dtype=np.float32)
+    query_vectors = np.asarray([embedding_model.embed_query(query) for query in queries], dtype=np.float32)
+    reference_top_k = top_k_indices(corpus, query_vectors, args.k)
+
+    reference_size = vectors_file_size(corpus)
+    failed = False
+    for vector_dimension in args.dimensions:
+        if vector_dimension > corpus.shape[1]:
+            continue
+        for vector_dtype in ("float32", "float16"):
+            compact_corpus = compact_vectors(corpus, vector_dimension, vector_dtype)
+            compact_queries = compact_vectors(query_vectors, vector_dimension, vector_dtype)
+            recall = recall_at_k(reference_top_k, top_k_indices(compact_corpus, compact_queries, args.k))
+            size = vectors_file_size(compact_corpus)
+
+            logging.info(
+                f"{vector_dimension} dimensions, {vector_dtype}: recall@{args.k} {recall:.2%}, "
+                f"{size / 2**20:.1f} MiB on disk for {len(compact_corpus)} vectors "
+                f"({size / reference_size:.0%} of full precision)"
+            )
+            if recall < args.min_recall:
+                failed = True
+
+    if failed:
+        logging.warning(f"Some configurations are below a recall@{args.k} of {args.min_recall:.2%}, see above.")
+
+
+def vectors_file_size(vectors):
+    """Returns the size of the vectors file of the flat index holding the vectors in their dtype."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, FlatVectorStore.VECTORS_FILENAME)
+        np.save(path, vectors)
+        return os.path.getsize(path)
+
+
+if __name__ == "__main__":
+    main()
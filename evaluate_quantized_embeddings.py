@@ -0,0 +1,72 @@
+import argparse
+import logging
+import sys
+import time
+
+import numpy as np
+
+from config_loader import load_config
+from embeddings import get_SFR_Code_embedding_model, BatchedEmbeddings
+from retrieval_evaluation import top_k_indices, recall_at_k, mean_row_cosine_similarity
+from vectorstore import get_vectorstore
+from vectorstore_manifest import read_manifest
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+vectorstore_path = "data/vectorstore"
+evaluation_queries_path = "config_files/evaluation_queries.json"
+
+
+def embed_queries_timed(embedding_model, queries):
+    start_time = time.perf_counter()
+    query_vectors = [embedding_model.embed_query(query) for query in queries]
+    return np.asarray(query_vectors, dtype=np.float32), (time.perf_counter() - start_time) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the int8 embedding backend with the fp32 index.")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--min-recall", type=float, default=0.9)
+    args = parser.parse_args()
+
+    manifest = read_manifest(vectorstore_path)
+    model_name = manifest.get("embedding_model", "Salesforce/SFR-Embedding-Code-400M_R")
+    revision = manifest.get("embedding_model_revision")
+    if manifest.get("embedding_backend", "fp32") != "fp32":
+        logging.error("The reference vectorstore has to be built with the fp32 backend.")
+        sys.exit(1)
+
+    queries = load_config(evaluation_queries_path)["queries"]
+
+    fp32_model = get_SFR_Code_embedding_model(model_name, device="cpu", revision=revision)
+    int8_model = get_SFR_Code_embedding_model(model_name, device="cpu", revision=revision, backend="int8")
+
+    stored_data = get_vectorstore(fp32_model, vectorstore_path, "flat").get(include=["documents", "embeddings"])
+    fp32_corpus = np.asarray(stored_data["embeddings"], dtype=np.float32)
+    logging.info(f"Re-embedding {len(stored_data['documents'])} indexed chunks with the int8 backend.")
+    int8_corpus = np.asarray(BatchedEmbeddings(int8_model).embed_documents(stored_data["documents"]), dtype=np.float32)
+
+    fp32_queries, fp32_query_time = embed_queries_timed(fp32_model, queries)
+    int8_queries, int8_query_time = embed_queries_timed(int8_model, queries)
+
+    reference_top_k = top_k_indices(fp32_corpus, fp32_queries, args.k)
+    int8_recall = recall_at_k(reference_top_k, top_k_indices(int8_corpus, int8_queries, args.k))
+    mixed_recall = recall_at_k(reference_top_k, top_k_indices(fp32_corpus, int8_queries, args.k))
+
+    logging.info(f"Mean cosine similarity of fp32 and int8 chunk embeddings: {mean_row_cosine_similarity(fp32_corpus, int8_corpus):.4f}")
+    logging.info(f"Mean cosine similarity of fp32 and int8 query embeddings: {mean_row_cosine_similarity(fp32_queries, int8_queries):.4f}")
+    logging.info(f"Recall@{args.k} of the int8 index with int8 queries: {int8_recall:.2%}")
+    logging.info(f"Recall@{args.k} of the fp32 index with int8 queries (mixed, not supported): {mixed_recall:.2%}")
+    logging.info(f"Query embedding latency: fp32 {fp32_query_time * 1000:.1f}ms, int8 {int8_query_time * 1000:.1f}ms")
+
+    if int8_recall < args.min_recall:
+        logging.error(f"Recall@{args.k} of the int8 backend is below {args.min_recall:.2%}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
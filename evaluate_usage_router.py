@@ -0,0 +1,80 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from config_loader import load_config
+from kadi_apy_ragchain import KadiApyRagchain
+from library_usage_router import CentroidUsageRouter, USAGE_CENTROIDS_FILENAME
+from llm import get_groq_llm
+from vectorstore import get_vectorstore, get_query_embedding_model
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+vectorstore_path = "data/vectorstore"
+evaluation_queries_path = "config_files/evaluation_queries.json"
+app_settings_path = "config_files/app_settings.json"
+
+
+def evaluate_usage_router(ragchain, usage_router, queries):
+    """
+    Compares the predictions of the local usage router with the predictions of the LLM.
+
+    Returns:
+        dict: The overall agreement, the agreement on confident router predictions and the share of
+              queries that would fall back to the LLM.
+    """
+    agreements = 0
+    confident_predictions = 0
+    confident_agreements = 0
+
+    for query in queries:
+        llm_usage = ragchain.predict_library_usage(query).strip()
+        router_usage, margin = usage_router.route(ragchain._embed_query(query))
+        is_confident = margin >= usage_router.min_margin
+
+        agreements += router_usage == llm_usage
+        if is_confident:
+            confident_predictions += 1
+            confident_agreements += router_usage == llm_usage
+
+        logging.info(f"LLM: {llm_usage:<14} Router: {router_usage:<14} Margin: {margin:.4f}  Query: {query}")
+
+    return {
+        "agreement": agreements / len(queries),
+        "confident_agreement": confident_agreements / confident_predictions if confident_predictions else None,
+        "fallback_rate": 1 - confident_predictions / len(queries),
+    }
+
+
+def main():
+    load_dotenv()
+
+    app_settings = load_config(app_settings_path)
+    queries = load_config(evaluation_queries_path)["queries"]
+
+    # Queries are embedded with the model, revision, backend and vector options recorded in the manifest,
+    # so they are in the same space as the chunks the router centroids were computed from
+    vectorstore = get_vectorstore(get_query_embedding_model(vectorstore_path), vectorstore_path, "flat")
+    llm = get_groq_llm("qwen-2.5-coder-32b", "0.0", os.environ["GROQ_API_KEY"])
+    usage_router = CentroidUsageRouter.load(
+        os.path.join(vectorstore_path, USAGE_CENTROIDS_FILENAME),
+        min_margin=app_settings["usage_router"]["min_margin"],
+    )
+
+    # The ragchain has no usage router, so its predictions always come from the LLM
+    ragchain = KadiApyRagchain(llm, vectorstore)
+    results = evaluate_usage_router(ragchain, usage_router, queries)
+
+    logging.info(f"Agreement with the LLM on all queries: {results['agreement']:.2%}")
+    if results["confident_agreement"] is not None:
+        logging.info(f"Agreement with the LLM on confident router predictions: {results['confident_agreement']:.2%}")
+    logging.info(f"Share of queries falling back to the LLM: {results['fallback_rate']:.2%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,18 @@
-from huggingface_hub import HfApi, login
+from huggingface_hub import HfApi, login, snapshot_download
+from huggingface_hub.utils import EntryNotFoundError
+import os
 import requests
 
+def get_vectorstore_repo(huggingface_parameters):
+    """
+    Returns the ID and type of the repository the vectorstore is published to: the separate repository
+    (hf_vectorstore_repo_id) if one is configured, the repository of the Space otherwise.
+    """
+    if huggingface_parameters.get("hf_vectorstore_repo_id"):
+        return huggingface_parameters["hf_vectorstore_repo_id"], huggingface_parameters.get("hf_vectorstore_repo_type", "dataset")
+    return huggingface_parameters["hf_repo_id"], huggingface_parameters["hf_repo_type"]
+
+
 def upload_folder_to_huggingface(folder_path, hf_repo_id, hf_repo_type, vectorstore_path):
     """Uploads a folder to Hugging Face."""
     login()  # Ensure the user is authenticated
@@ -20,6 +32,54 @@ def upload_folder_to_huggingface(folder_path, hf_repo_id, hf_repo_type, vectorst
     return response
 
 
+def download_folder_from_huggingface(folder_path, hf_repo_id, hf_repo_type, local_dir, allow_patterns=None, ignore_patterns=None, revision=None):
+    """
+    Downloads a folder of a Hugging Face repository into local_dir, keeping its path in the repository.
+
+    Parameters:
+        folder_path (str): The folder to download (relative to the repository root).
+        allow_patterns (list): Patterns of the files to download, relative to the folder. All files by default.
+        ignore_patterns (list): Patterns of the files to skip, relative to the folder.
+        revision (str): The commit to download from. The latest commit by default.
+
+    Returns:
+        str: The local path of the folder.
+    """
+    print(f"Downloading folder: {folder_path} from repo: {hf_repo_id} (type: {hf_repo_type})")
+
+    snapshot_download(
+        repo_id=hf_repo_id,
+        repo_type=hf_repo_type,
+        local_dir=local_dir,
+        allow_patterns=[f"{folder_path}/{pattern}" for pattern in allow_patterns or ["*"]],
+        ignore_patterns=[f"{folder_path}/{pattern}" for pattern in ignore_patterns or []],
+        revision=revision,
+    )
+    return os.path.join(local_dir, folder_path)
+
+
+def get_latest_revision(hf_repo_id, hf_repo_type):
+    """Returns the hash of the latest commit of a Hugging Face repository."""
+    return HfApi().repo_info(repo_id=hf_repo_id, repo_type=hf_repo_type).sha
+
+
+def get_folder_file_sizes(folder_path, hf_repo_id, hf_repo_type):
+    """
+    Returns the sizes in bytes of the files in a folder of a Hugging Face repository, by their path relative to
+    the folder. The sizes are the ones of the stored files, e.g. of the LFS objects, not of their pointers.
+    An empty dict is returned if the folder does not exist.
+    """
+    try:
+        entries = HfApi().list_repo_tree(hf_repo_id, path_in_repo=folder_path, repo_type=hf_repo_type, recursive=True)
+        return {
+            os.path.relpath(entry.path, folder_path): entry.size
+            for entry in entries
+            if getattr(entry, "size", None) is not None
+        }
+    except EntryNotFoundError:
+        return {}
+
+
 def delete_folder_from_huggingface(path_in_repo, repo_id, repo_type=None):
     """Deletes a folder from a Hugging Face repository."""
 
@@ -34,18 +94,20 @@ def delete_folder_from_huggingface(path_in_repo, repo_id, repo_type=None):
     )
     return response
 
-def check_folder_exists(repo_id, folder_path):
+def check_folder_exists(repo_id, folder_path, repo_type="space"):
     """
-    Checks if a folder exists in a Hugging Face Space repository.
+    Checks if a folder exists in a Hugging Face repository.
 
     Parameters:
-        repo_id (str): The ID of the Hugging Face Space repository (e.g., "username/repo_name").
+        repo_id (str): The ID of the Hugging Face repository (e.g., "username/repo_name").
         folder_path (str): The folder path to check (relative to the repository root).
+        repo_type (str): The type of the repository, "space", "dataset" or "model".
 
     Returns:
         bool: True if the folder exists, False otherwise.
     """
-    url = f"https://huggingface.co/spaces/{repo_id}/tree/main/{folder_path}"
+    url_prefixes = {"space": "spaces/", "dataset": "datasets/", "model": ""}
+    url = f"https://huggingface.co/{url_prefixes[repo_type or 'model']}{repo_id}/tree/main/{folder_path}"
     
     try:
         response = requests.get(url)
@@ -1,48 +1,282 @@
+import asyncio
+import logging
+import time
+
+from langchain.schema import Document
+
+from bm25_index import reciprocal_rank_fusion
+from tracing import Tracer, token_usage
+
+logger = logging.getLogger(__name__)
+
+
 class KadiApyRagchain:
     
-    def __init__(self, llm, vector_store):
+    def __init__(self, llm, vector_store, response_cache=None, llm_result_cache=None, history_manager=None, query_embedder=None, lexical_index=None, usage_router=None, tracer=None, context_packer=None, symbol_table=None, max_expanded_chunks=4):
         """
-        Initialize the RAGChain with an LLM instance, a vector store
+        Initialize the RAGChain with an LLM instance, a vector store, an optional semantic response cache,
+        an optional persistent cache for the results of the query rewriting and library usage prediction,
+        an optional history manager that keeps the chat history in the prompt bounded, an optional
+        query embedder with which the vector store is searched by vector, an optional BM25 index
+        whose results are fused with the vector store results, an optional local router that
+        predicts the library usage without an LLM call, an optional tracer recording the latency
+        of each stage, an optional context packer that merges, deduplicates and budgets the
+        retrieved chunks before they are put into the prompt and an optional symbol table with which
+        up to max_expanded_chunks class headers, __init__ methods and other pieces of the retrieved
+        symbols are added to the code contexts
         """
         self.llm = llm
         self.vector_store = vector_store
+        self.response_cache = response_cache
+        self.llm_result_cache = llm_result_cache
+        self.history_manager = history_manager
+        self.query_embedder = query_embedder
+        self.lexical_index = lexical_index
+        self.usage_router = usage_router
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.context_packer = context_packer
+        self.symbol_table = symbol_table
+        self.max_expanded_chunks = max_expanded_chunks
+
+    def swap_indexes(self, vector_store, lexical_index=None, usage_router=None, symbol_table=None):
+        """
+        Replaces the vector store, the BM25 index, the usage router and the symbol table with those of a new
+        vectorstore version and returns the old ones. Requests in progress may still be using the old indexes, so they should only be
+        released once those requests are drained. Cached responses of the old version are dropped.
+        """
+        old_indexes = (self.vector_store, self.lexical_index, self.usage_router, self.symbol_table)
+        self.vector_store, self.lexical_index, self.usage_router, self.symbol_table = vector_store, lexical_index, usage_router, symbol_table
+        if self.response_cache is not None:
+            self.response_cache.invalidate()
+        return old_indexes
 
 
     def process_query(self, query, chat_history):
         """
         Process a user query, handle history, retrieve contexts, and generate a response.
         """
-
+        query_embedding = None
+        if self._is_response_cacheable(chat_history):
+            query_embedding = self.response_cache.embed_query(query)
+            cached_response = self._lookup_cached_response(query, query_embedding)
+            if cached_response is not None:
+                return cached_response
         
         # Rewrite query
         rewritten_query = self.rewrite_query(query)
-        print("Rewritten Query: ",rewritten_query)
+        logger.debug(f"Rewritten query: {rewritten_query}")
         # Predict library usage
-        print("Start prediction:")
         code_library_usage_prediction = self.predict_library_usage(query)
+        logger.debug(f"Predicted library usage: {code_library_usage_prediction}")
         
         # Retrieve contexts
-        print("Start retrieving:")
-
-        
-        code_contexts = self.retrieve_contexts(rewritten_query, k=3, filter={"usage": code_library_usage_prediction})
-        doc_contexts = self.retrieve_contexts(query, k=2, filter={"dataset_category": "kadi_apy_docs"})
+        # Both queries are embedded in a single pass
+        code_query_embedding, doc_query_embedding = self._embed_queries([rewritten_query, query])
+        code_contexts = self.retrieve_contexts(rewritten_query, k=3, filter={"usage": code_library_usage_prediction}, query_embedding=code_query_embedding, stage="retrieve-code")
+        doc_contexts = self.retrieve_contexts(query, k=2, filter={"dataset_category": "kadi_apy_docs"}, query_embedding=doc_query_embedding, stage="retrieve-docs")
      
         # Format contexts
-        print("Formatting docs:")
-        formatted_doc_contexts = self.format_documents(doc_contexts)
-        formatted_code_contexts = self.format_documents(code_contexts)
+        formatted_doc_contexts, formatted_code_contexts = self._format_contexts(doc_contexts, code_contexts)
         
         # Generate response
-        print("Start generatin repsonsse:")
         response = self.generate_response(query, chat_history, formatted_doc_contexts, formatted_code_contexts)
         #response = self.generate_response(query, chat_history, formatted_contexts)
+        self._store_cached_response(query, response, query_embedding)
+        return response
+
+    async def aprocess_query(self, query, chat_history):
+        """
+        Asynchronous variant of process_query. Query rewriting, library usage prediction and the
+        documentation lookup run concurrently; only the code lookup waits for both LLM results.
+        """
+        query_embedding = None
+        if self._is_response_cacheable(chat_history):
+            query_embedding = await asyncio.to_thread(self.response_cache.embed_query, query)
+            cached_response = self._lookup_cached_response(query, query_embedding)
+            if cached_response is not None:
+                return cached_response
+
+        # A summary of older turns is requested from the LLM while the contexts are retrieved
+        history_task = asyncio.create_task(self._aformat_prompt_history(chat_history))
+        try:
+            async for event, value in self._aretrieve_formatted_contexts(query):
+                if event == "contexts":
+                    formatted_doc_contexts, formatted_code_contexts = value
+
+            response = await self.agenerate_response(
+                query, chat_history, formatted_doc_contexts, formatted_code_contexts, history_task=history_task
+            )
+        finally:
+            if not history_task.done():
+                history_task.cancel()
+        self._store_cached_response(query, response, query_embedding)
         return response
+
+    async def astream_query(self, query, chat_history):
+        """
+        Streaming variant of aprocess_query. Yields ("status", message) tuples while the contexts are
+        retrieved, followed by ("token", text) tuples as the LLM generates the response.
+        """
+        query_embedding = None
+        if self._is_response_cacheable(chat_history):
+            query_embedding = await asyncio.to_thread(self.response_cache.embed_query, query)
+            cached_response = self._lookup_cached_response(query, query_embedding)
+            if cached_response is not None:
+                yield "token", cached_response
+                return
+
+        # A summary of older turns is requested from the LLM while the contexts are retrieved
+        history_task = asyncio.create_task(self._aformat_prompt_history(chat_history))
+        try:
+            async for event, value in self._aretrieve_formatted_contexts(query):
+                if event == "contexts":
+                    formatted_doc_contexts, formatted_code_contexts = value
+                else:
+                    yield event, value
+
+            yield "status", "Generating response..."
+            response = ""
+            async for chunk in self.astream_response(
+                query, chat_history, formatted_doc_contexts, formatted_code_contexts, history_task=history_task
+            ):
+                response += chunk
+                yield "token", chunk
+        finally:
+            if not history_task.done():
+                history_task.cancel()
+
+        self._store_cached_response(query, response, query_embedding)
+
+    async def _aretrieve_formatted_contexts(self, query):
+        """
+        Run the pre-generation stages concurrently. Yields ("status", message) tuples for each stage
+        and finally a ("contexts", (formatted_doc_contexts, formatted_code_contexts)) tuple.
+        """
+        rewrite_task = asyncio.create_task(self.arewrite_query(query))
+        tasks = [rewrite_task]
+
+        try:
+            yield "status", "Rewriting query and searching the documentation..."
+
+            # The raw query is embedded once up front, so the usage router and the documentation lookup
+            # share the embedding instead of both missing the query embedding cache at the same time
+            query_embedding = None
+            if self.usage_router is not None or self.query_embedder is not None:
+                with self.tracer.span("embed"):
+                    query_embedding = await asyncio.to_thread(self._embed_query, query)
+
+            prediction_task = asyncio.create_task(self.apredict_library_usage(query, query_embedding))
+            doc_contexts_task = asyncio.create_task(
+                self.aretrieve_contexts(
+                    query, k=2, filter={"dataset_category": "kadi_apy_docs"}, query_embedding=query_embedding, stage="retrieve-docs"
+                )
+            )
+            tasks.extend([prediction_task, doc_contexts_task])
+
+            rewritten_query, code_library_usage_prediction = await asyncio.gather(rewrite_task, prediction_task)
+            logger.debug(f"Rewritten query: {rewritten_query}")
+            logger.debug(f"Predicted library usage: {code_library_usage_prediction}")
+
+            yield "status", f"Searching source code in {code_library_usage_prediction}..."
+            code_contexts = await self.aretrieve_contexts(
+                rewritten_query, k=3, filter={"usage": code_library_usage_prediction}, stage="retrieve-code"
+            )
+            doc_contexts = await doc_contexts_task
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        formatted_doc_contexts, formatted_code_contexts = self._format_contexts(doc_contexts, code_contexts)
+
+        yield "contexts", (formatted_doc_contexts, formatted_code_contexts)
+
+    def _format_contexts(self, doc_contexts, code_contexts):
+        if self.symbol_table is not None:
+            code_contexts = self.expand_contexts(code_contexts)
+
+        with self.tracer.span("format") as span:
+            span.set(chunks=len(doc_contexts) + len(code_contexts))
+            if self.context_packer is not None:
+                doc_contexts = self.context_packer.pack(doc_contexts, self.context_packer.doc_token_budget)
+                code_contexts = self.context_packer.pack(code_contexts, self.context_packer.code_token_budget)
+                span.set(packed_chunks=len(doc_contexts) + len(code_contexts))
+
+            formatted_doc_contexts = self.format_documents(doc_contexts)
+            formatted_code_contexts = self.format_documents(code_contexts)
+
+        return formatted_doc_contexts, formatted_code_contexts
         
+    def expand_contexts(self, contexts):
+        """
+        Adds the chunks related to the retrieved chunks by the symbol table, e.g. the class header and __init__
+        method of a retrieved method, right after the chunk they belong to. The related chunks are fetched by
+        their IDs, at most max_expanded_chunks of them.
+        """
+        with self.tracer.span("expand") as span:
+            retrieved_ids = {doc.metadata.get("chunk_id") for doc in contexts}
+            related_ids_per_doc = []
+            expansion_ids = []
+            for doc in contexts:
+                related_ids = [
+                    related_id for related_id in self.symbol_table.related_chunk_ids(doc.metadata)
+                    if related_id not in retrieved_ids and related_id not in expansion_ids
+                ][:self.max_expanded_chunks - len(expansion_ids)]
+                related_ids_per_doc.append(related_ids)
+                expansion_ids.extend(related_ids)
+
+            if not expansion_ids:
+                span.set(expanded_chunks=0)
+                return contexts
+
+            stored_data = self.vector_store.get(ids=expansion_ids, include=["documents", "metadatas"])
+            related_docs = {
+                chunk_id: Document(page_content=page_content, metadata=metadata)
+                for chunk_id, page_content, metadata in zip(stored_data["ids"], stored_data["documents"], stored_data["metadatas"])
+            }
+
+            expanded_contexts = []
+            for doc, related_ids in zip(contexts, related_ids_per_doc):
+                expanded_contexts.append(doc)
+                expanded_contexts.extend(related_docs[related_id] for related_id in related_ids if related_id in related_docs)
+            span.set(expanded_chunks=len(expanded_contexts) - len(contexts))
+
+        return expanded_contexts
+
+    def _lookup_cached_response(self, query, query_embedding):
+        with self.tracer.span("semantic-cache") as span:
+            cached_response = self.response_cache.lookup(query, query_embedding)
+            span.set(cache_hit=cached_response is not None)
+
+        return cached_response
+
+    def _is_response_cacheable(self, chat_history):
+        """
+        Cached answers are only used for the first turn of a chat, as later turns may depend on the chat history.
+        """
+        if self.response_cache is None:
+            return False
+        return not any(entry[1] is not None for entry in chat_history)
+
+    def _store_cached_response(self, query, response, query_embedding):
+        if query_embedding is not None and response:
+            self.response_cache.store(query, response, query_embedding)
+
     def rewrite_query(self, query):
         """
         Rewrite the user's query to align with the language and structure of the library's methods and documentation.
         """
+        with self.tracer.span("rewrite") as span:
+            return self._cached_llm_call(self._build_rewrite_prompt, query, span)
+
+    async def arewrite_query(self, query):
+        """
+        Asynchronous variant of rewrite_query.
+        """
+        with self.tracer.span("rewrite") as span:
+            return await self._acached_llm_call(self._build_rewrite_prompt, query, span)
+
+    def _build_rewrite_prompt(self, query):
         rewrite_prompt = (
             f"""You are an intelligent assistant that helps users rewrite their queries.
                 The vectorstore consists of the source code and documentation of a Python library, which enables users to 
@@ -74,12 +308,37 @@ class KadiApyRagchain:
                     {query}
             """
         )
-        return self.llm.invoke(rewrite_prompt).content
+        return rewrite_prompt
     
     def predict_library_usage(self, query):
         """
-        Use the LLM to predict the relevant library for the user's query.
+        Use the local usage router or, if its prediction is not confident, the LLM to predict the relevant library for the user's query.
+        """
+        with self.tracer.span("predict") as span:
+            if self.usage_router is not None:
+                usage = self.usage_router.predict(self._embed_query(query))
+                span.set(router_hit=usage is not None)
+                if usage is not None:
+                    return usage
+
+            return self._cached_llm_call(self._build_library_usage_prompt, query, span)
+
+    async def apredict_library_usage(self, query, query_embedding=None):
+        """
+        Asynchronous variant of predict_library_usage. The router uses the query embedding if it is given.
         """
+        with self.tracer.span("predict") as span:
+            if self.usage_router is not None:
+                if query_embedding is None:
+                    query_embedding = await asyncio.to_thread(self._embed_query, query)
+                usage = self.usage_router.predict(query_embedding)
+                span.set(router_hit=usage is not None)
+                if usage is not None:
+                    return usage
+
+            return await self._acached_llm_call(self._build_library_usage_prompt, query, span)
+
+    def _build_library_usage_prompt(self, query):
         prompt = (
             f"""The query is: '{query}'.
                 Based on the user's query, assist them by determining which technical document they should read to interact with the software named 'Kadi4Mat'. 
@@ -93,21 +352,162 @@ class KadiApyRagchain:
                 Respond with only the exact corresponding option and do not include any additional comments, explanations, or text."
             """
         )
-        return self.llm.predict(prompt)
+        return prompt
+
+    def _cached_llm_call(self, build_prompt, query, span):
+        """
+        Invoke the LLM with the prompt built for the query, reusing a persisted result of an earlier identical call.
+        Cache hits and token counts are added to the span.
+        """
+        cache_key = self._llm_result_cache_key(build_prompt, query)
+        if cache_key is not None:
+            cached_result = self.llm_result_cache.get(cache_key)
+            span.set(cache_hit=cached_result is not None)
+            if cached_result is not None:
+                return cached_result
+
+        response = self.llm.invoke(build_prompt(query))
+        span.set(**token_usage(response))
+        result = response.content
+
+        if cache_key is not None:
+            self.llm_result_cache.set(cache_key, result)
+        return result
 
-    def retrieve_contexts(self, query, k, filter = None):
+    async def _acached_llm_call(self, build_prompt, query, span):
+        """
+        Asynchronous variant of _cached_llm_call. The SQLite lookups run in a worker thread, so they do not block
+        the event loop.
+        """
+        cache_key = self._llm_result_cache_key(build_prompt, query)
+        if cache_key is not None:
+            cached_result = await asyncio.to_thread(self.llm_result_cache.get, cache_key)
+            span.set(cache_hit=cached_result is not None)
+            if cached_result is not None:
+                return cached_result
+
+        response = await self.llm.ainvoke(build_prompt(query))
+        span.set(**token_usage(response))
+        result = response.content
+
+        if cache_key is not None:
+            await asyncio.to_thread(self.llm_result_cache.set, cache_key, result)
+        return result
+
+    def _llm_result_cache_key(self, build_prompt, query):
+        if self.llm_result_cache is None:
+            return None
+
+        model_name = getattr(self.llm, "model_name", None)
+        # Building the prompt with the placeholder itself yields the prompt template
+        prompt_template = build_prompt("{query}")
+        return self.llm_result_cache.make_key(model_name, prompt_template, query)
+
+    def retrieve_contexts(self, query, k, filter = None, query_embedding = None, stage = "retrieve"):
         """
         Retrieve relevant documents and source code based on the query and library usage prediction.
+        If a query embedder is set, the vector store is searched by the (cached) query embedding.
+        If a lexical index is set, its results are fused with the vector store results by reciprocal rank fusion.
+        The retrieval is traced as the given stage.
         """
-        context = self.vector_store.similarity_search(query = query, k=k, filter=filter)       
+        with self.tracer.span(stage) as span:
+            if query_embedding is None and self.query_embedder is not None:
+                query_embedding = self.query_embedder.embed_query(query)
+
+            if query_embedding is not None:
+                context = self.vector_store.similarity_search_by_vector(query_embedding, k=k, filter=filter)
+            else:
+                context = self.vector_store.similarity_search(query = query, k=k, filter=filter)       
+
+            if self.lexical_index is not None:
+                lexical_context = self.lexical_index.search(query, k=k, filter=filter)
+                context = reciprocal_rank_fusion([context, lexical_context], k)
+
+            span.set(chunks=len(context))
+
         return context
 
+    async def aretrieve_contexts(self, query, k, filter = None, query_embedding = None, stage = "retrieve"):
+        """
+        Asynchronous variant of retrieve_contexts.
+        """
+        return await asyncio.to_thread(self.retrieve_contexts, query, k, filter, query_embedding, stage)
+
+    def _embed_queries(self, queries):
+        if self.query_embedder is None:
+            return [None] * len(queries)
+        return self.query_embedder.embed_queries(queries)
+
+    def _embed_query(self, query):
+        if self.query_embedder is None:
+            return self.vector_store.embeddings.embed_query(query)
+        return self.query_embedder.embed_query(query)
+
     def generate_response(self, query, chat_history, doc_context, code_context):
         """
         Generate a response using the retrieved contexts and the LLM.
         """     
-        formatted_history = self.format_history(chat_history)
-        
+        formatted_history = self._format_prompt_history(chat_history)
+        prompt = self._build_response_prompt(query, formatted_history, doc_context, code_context)
+        with self.tracer.span("generate") as span:
+            response = self.llm.invoke(prompt)
+            span.set(**token_usage(response))
+        return response.content
+
+    async def agenerate_response(self, query, chat_history, doc_context, code_context, history_task=None):
+        """
+        Asynchronous variant of generate_response. The formatted history is taken from history_task if
+        it was already started.
+        """
+        formatted_history = await (history_task or self._aformat_prompt_history(chat_history))
+        prompt = self._build_response_prompt(query, formatted_history, doc_context, code_context)
+        with self.tracer.span("generate") as span:
+            response = await self.llm.ainvoke(prompt)
+            span.set(**token_usage(response))
+        return response.content
+
+    def stream_response(self, query, chat_history, doc_context, code_context):
+        """
+        Streaming variant of generate_response. Yields the response text chunk by chunk.
+        """
+        formatted_history = self._format_prompt_history(chat_history)
+        prompt = self._build_response_prompt(query, formatted_history, doc_context, code_context)
+        with self.tracer.span("generate") as span:
+            start_time = time.perf_counter()
+            for chunk in self.llm.stream(prompt):
+                span.set(**token_usage(chunk))
+                if chunk.content:
+                    if "time_to_first_token" not in span.attributes:
+                        span.set(time_to_first_token=time.perf_counter() - start_time)
+                    yield chunk.content
+
+    async def astream_response(self, query, chat_history, doc_context, code_context, history_task=None):
+        """
+        Asynchronous variant of stream_response. The formatted history is taken from history_task if
+        it was already started.
+        """
+        formatted_history = await (history_task or self._aformat_prompt_history(chat_history))
+        prompt = self._build_response_prompt(query, formatted_history, doc_context, code_context)
+        with self.tracer.span("generate") as span:
+            start_time = time.perf_counter()
+            async for chunk in self.llm.astream(prompt):
+                span.set(**token_usage(chunk))
+                if chunk.content:
+                    if "time_to_first_token" not in span.attributes:
+                        span.set(time_to_first_token=time.perf_counter() - start_time)
+                    yield chunk.content
+
+    def _format_prompt_history(self, chat_history):
+        if self.history_manager is None:
+            return self.format_history(chat_history)
+        return self.history_manager.format_history(chat_history)
+
+    async def _aformat_prompt_history(self, chat_history):
+        if self.history_manager is None:
+            return self.format_history(chat_history)
+        return await self.history_manager.aformat_history(chat_history)
+
+    def _build_response_prompt(self, query, formatted_history, doc_context, code_context):
         # Update the prompt with history included
         prompt = f"""
             You are a Python programming assistant specialized in the "Kadi-APY" library. 
@@ -136,7 +536,7 @@ class KadiApyRagchain:
             Query:
             {query}
         """
-        return self.llm.invoke(prompt).content
+        return prompt
 
     
     def format_documents(self, documents):
@@ -147,16 +547,10 @@ class KadiApyRagchain:
             all_metadata = doc.metadata
             
             metadata_str = ", ".join(f"{key}: {value}" for key, value in all_metadata.items())
-            print("\n")
-            print("------------------------------Beneath is retrieved doc------------------------------------------------")
-            print(metadata_str)
+            logger.debug(f"Retrieved snippet {i} ({metadata_str}):\n{doc.page_content}")
             formatted_docs.append(metadata_str)
-            print("\n")
             formatted_docs.append("\n")
             formatted_docs.append(doc.page_content)
-            print(doc.page_content)
-            print("\n\n")
-            print("------------------------------End  of retrived doc------------------------------------------------")
             formatted_docs.append("\n\n")
             
         return formatted_docs
@@ -0,0 +1,73 @@
+import json
+
+import numpy as np
+
+USAGE_CENTROIDS_FILENAME = "usage_centroids.json"
+
+
+class CentroidUsageRouter:
+    """
+    Predicts the library usage ("kadi_apy/lib/" or "kadi_apy/cli/") of a query without an LLM call, by comparing
+    the query embedding with the centroids of the embeddings of the indexed chunks of each usage.
+    """
+
+    def __init__(self, centroids, min_margin=0.02):
+        """
+        Parameters:
+            centroids (dict): Maps each usage to the normalized centroid of its chunk embeddings.
+            min_margin (float): Minimum difference between the cosine similarities of the best and the
+                second best usage for the prediction to be considered confident.
+        """
+        self.usages = list(centroids)
+        self.centroid_matrix = np.asarray([centroids[usage] for usage in self.usages], dtype=np.float32)
+        self.min_margin = min_margin
+
+    @classmethod
+    def from_embeddings(cls, embeddings, metadatas, min_margin=0.02):
+        """Computes the centroids from the chunk embeddings, ignoring chunks without usage metadata."""
+        sums = {}
+        for embedding, metadata in zip(embeddings, metadatas):
+            usage = (metadata or {}).get("usage")
+            if usage is None:
+                continue
+            sums[usage] = sums.get(usage, 0.0) + _normalize(embedding)
+
+        return cls({usage: _normalize(vector_sum) for usage, vector_sum in sums.items()}, min_margin)
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(
+                {usage: centroid.tolist() for usage, centroid in zip(self.usages, self.centroid_matrix)},
+                file,
+            )
+
+    @classmethod
+    def load(cls, path, min_margin=0.02):
+        with open(path, "r") as file:
+            centroids = json.load(file)
+        return cls(centroids, min_margin)
+
+    def route(self, query_embedding):
+        """
+        Returns the most likely usage and the margin to the second most likely usage.
+        """
+        similarities = self.centroid_matrix @ _normalize(query_embedding)
+        ranking = np.argsort(similarities)[::-1]
+
+        margin = float(similarities[ranking[0]] - similarities[ranking[1]]) if len(ranking) > 1 else float("inf")
+        return self.usages[ranking[0]], margin
+
+    def predict(self, query_embedding):
+        """Returns the predicted usage, or None if the margin is too low for a confident prediction."""
+        usage, margin = self.route(query_embedding)
+        if margin < self.min_margin:
+            return None
+        return usage
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
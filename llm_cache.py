@@ -0,0 +1,97 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+class LLMResultCache:
+    """
+    Disk-backed cache for the results of deterministic LLM calls, stored in a SQLite database.
+
+    Entries are evicted in least recently used order once max_entries is exceeded.
+    """
+
+    def __init__(self, db_path, max_entries=10000, touch_interval_seconds=300):
+        """
+        Parameters:
+            db_path (str): Path of the SQLite database file, created if it does not exist.
+            max_entries (int): Maximum number of cached results.
+            touch_interval_seconds (float): Minimum age of the stored access time before a hit refreshes it.
+                Hits on recently used entries are pure reads and write nothing to the database.
+        """
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.touch_interval_seconds = touch_interval_seconds
+
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_results (key TEXT PRIMARY KEY, result TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON llm_results (last_access)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(model_name, prompt_template, query):
+        """Builds the cache key from the model name, the prompt template and the normalized query."""
+        key_source = "\0".join([model_name or "", prompt_template, normalize_query(query)])
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached result for the key or None."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT result, last_access FROM llm_results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            result, last_access = row
+            now = time.time()
+            # The eviction order only needs coarse access times, so an entry used within the touch interval
+            # is not written again
+            if now - last_access >= self.touch_interval_seconds:
+                self._connection.execute("UPDATE llm_results SET last_access = ? WHERE key = ?", (now, key))
+                self._connection.commit()
+            self.hits += 1
+            return result
+
+    def set(self, key, result):
+        """Stores a result and evicts the least recently used entries above max_entries."""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_results (key, result, last_access) VALUES (?, ?, ?)",
+                (key, result, time.time()),
+            )
+            self._connection.execute(
+                """DELETE FROM llm_results WHERE key IN (
+                    SELECT key FROM llm_results ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+            self._connection.commit()
+
+    def stats(self):
+        """Returns the hit and miss counters and the number of stored entries."""
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM llm_results").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def normalize_query(query):
+    """Lowercases the query and collapses whitespace, so trivially different spellings share a cache entry."""
+    return re.sub(r"\s+", " ", query).strip().casefold()
@@ -0,0 +1,192 @@
+"""
+Evaluation of Chroma-style metadata filters for the indexes that are not backed by Chroma.
+
+Supported are plain equality filters ({"usage": "kadi_apy/lib/"}), the operators $eq, $ne, $in, $nin,
+$gt, $gte, $lt and $lte on a field, and the logical operators $and and $or.
+"""
+
+import json
+import os
+
+import numpy as np
+
+_COMPARISONS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+}
+
+
+def matches_filter(metadata, filter):
+    """Checks whether the metadata of a document satisfies the filter. An empty filter matches everything."""
+    if not filter:
+        return True
+
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, sub_filter) for sub_filter in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, sub_filter) for sub_filter in condition):
+                return False
+        elif not _matches_condition(metadata.get(key), condition):
+            return False
+
+    return True
+
+
+def _matches_condition(value, condition):
+    if not isinstance(condition, dict):
+        return value == condition
+
+    for operator, operand in condition.items():
+        if operator not in _COMPARISONS:
+            raise ValueError(f"Unsupported filter operator: {operator}")
+        if not _COMPARISONS[operator](value, operand):
+            return False
+
+    return True
+
+
+PARTITION_FIELDS = ("usage", "dataset_category", "type")
+
+
+class MetadataPartitions:
+    """
+    Posting lists of the row numbers per value of the partition fields, so a filtered search only has to
+    touch the rows of its partitions instead of checking the metadata of every row.
+
+    Equality, $eq, $in, $ne and $nin conditions on the partition fields are resolved with set operations on
+    the sorted row arrays, also when nested in $and and $or. Other conditions do not narrow the candidates
+    and are checked by matches_filter on the candidate rows only.
+    """
+
+    PARTITIONS_FILENAME = "partitions.json"
+    PARTITION_ROWS_FILENAME = "partition_rows.npy"
+
+    def __init__(self, postings, number_of_rows):
+        """
+        Parameters:
+            postings (dict): Field name to a dict of each value to the sorted array of its rows.
+            number_of_rows (int): Number of rows of the index.
+        """
+        self.postings = postings
+        self.number_of_rows = number_of_rows
+
+    @classmethod
+    def from_metadatas(cls, metadatas, fields=PARTITION_FIELDS):
+        """Builds the posting lists of the partition fields from the metadata dict of every row."""
+        postings = {}
+        for row, metadata in enumerate(metadatas):
+            for field in fields:
+                value = (metadata or {}).get(field)
+                if value is not None:
+                    postings.setdefault(field, {}).setdefault(value, []).append(row)
+
+        postings = {
+            field: {value: np.asarray(rows, dtype=np.int64) for value, rows in field_postings.items()}
+            for field, field_postings in postings.items()
+        }
+        return cls(postings, len(metadatas))
+
+    def save(self, directory):
+        """
+        Writes all posting lists into one row array and their ranges in it into a small JSON file, so load can
+        memory-map the rows.
+        """
+        ranges = {}
+        row_arrays = []
+        offset = 0
+        for field, field_postings in self.postings.items():
+            ranges[field] = {}
+            for value, rows in field_postings.items():
+                ranges[field][value] = [offset, offset + len(rows)]
+                row_arrays.append(rows)
+                offset += len(rows)
+
+        np.save(os.path.join(directory, self.PARTITION_ROWS_FILENAME), np.concatenate(row_arrays) if row_arrays else _EMPTY_ROWS)
+        with open(os.path.join(directory, self.PARTITIONS_FILENAME), "w") as file:
+            json.dump({"number_of_rows": self.number_of_rows, "postings": ranges}, file)
+
+    @classmethod
+    def load(cls, directory):
+        rows = np.load(os.path.join(directory, cls.PARTITION_ROWS_FILENAME), mmap_mode="r")
+        with open(os.path.join(directory, cls.PARTITIONS_FILENAME), "r") as file:
+            data = json.load(file)
+
+        postings = {
+            field: {value: rows[start:stop] for value, (start, stop) in field_ranges.items()}
+            for field, field_ranges in data["postings"].items()
+        }
+        return cls(postings, data["number_of_rows"])
+
+    def candidate_rows(self, filter):
+        """
+        Returns the sorted candidate rows for the filter, or None if the filter does not narrow down the rows,
+        and whether the candidates satisfy the filter exactly, so matches_filter does not have to check them again.
+        """
+        if not filter:
+            return None, True
+
+        candidates = None
+        exact = True
+        for key, condition in filter.items():
+            if key == "$and":
+                parts = [self.candidate_rows(sub_filter) for sub_filter in condition]
+            elif key == "$or":
+                parts = [self.candidate_rows(sub_filter) for sub_filter in condition]
+                if any(rows is None for rows, _ in parts):
+                    # One unrestricted branch makes the whole disjunction unrestricted
+                    parts = [(None, False)]
+                else:
+                    rows = _union([rows for rows, _ in parts])
+                    parts = [(rows, all(part_exact for _, part_exact in parts))]
+            else:
+                parts = [self._condition_rows(key, condition)]
+
+            for rows, part_exact in parts:
+                exact = exact and part_exact
+                if rows is not None:
+                    candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+
+        return candidates, exact
+
+    def _condition_rows(self, field, condition):
+        field_postings = self.postings.get(field)
+        if field_postings is None:
+            return None, False
+
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+
+        candidates = None
+        exact = True
+        for operator, operand in condition.items():
+            if operator == "$eq":
+                rows = field_postings.get(operand, _EMPTY_ROWS)
+            elif operator == "$in":
+                rows = _union([field_postings.get(value, _EMPTY_ROWS) for value in operand])
+            elif operator in ("$ne", "$nin"):
+                excluded_values = [operand] if operator == "$ne" else operand
+                excluded_rows = _union([field_postings.get(value, _EMPTY_ROWS) for value in excluded_values])
+                rows = np.setdiff1d(np.arange(self.number_of_rows), excluded_rows, assume_unique=True)
+            else:
+                exact = False
+                continue
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+
+        return candidates, exact
+
+
+_EMPTY_ROWS = np.empty(0, dtype=np.int64)
+
+
+def _union(row_arrays):
+    if not row_arrays:
+        return _EMPTY_ROWS
+    return np.unique(np.concatenate(row_arrays))
@@ -0,0 +1,32 @@
+import numpy as np
+
+
+def normalize_rows(matrix):
+    """Scales every row to unit length, so dot products equal cosine similarities."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(corpus_matrix, query_matrix, k):
+    """Returns the indices of the k most cosine-similar corpus rows for every query, best first."""
+    similarities = normalize_rows(query_matrix) @ normalize_rows(corpus_matrix).T
+    k = min(k, similarities.shape[1])
+    top_k = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    top_k_similarities = np.take_along_axis(similarities, top_k, axis=1)
+    return np.take_along_axis(top_k, np.argsort(-top_k_similarities, axis=1), axis=1)
+
+
+def recall_at_k(reference_top_k, candidate_top_k):
+    """Returns the mean share of the reference top-k results that are also in the candidate top-k results."""
+    recalls = [
+        len(set(reference) & set(candidate)) / len(reference)
+        for reference, candidate in zip(reference_top_k.tolist(), candidate_top_k.tolist())
+    ]
+    return float(np.mean(recalls))
+
+
+def mean_row_cosine_similarity(first_matrix, second_matrix):
+    """Returns the mean cosine similarity between corresponding rows of two matrices."""
+    return float(np.mean(np.sum(normalize_rows(first_matrix) * normalize_rows(second_matrix), axis=1)))
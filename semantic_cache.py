@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticResponseCache:
+    """
+    In-memory cache of generated answers keyed by the embedding of the user query.
+
+    A lookup returns the stored answer of the most similar cached query if its cosine similarity
+    is above the configured threshold. Entries are evicted in LRU order once max_entries is reached
+    and expire after ttl_seconds. The whole cache is dropped when the vectorstore version changes.
+    """
+
+    def __init__(self, embedding_model, similarity_threshold=0.95, max_entries=512, ttl_seconds=None, version_provider=None, version_check_seconds=60):
+        """
+        Parameters:
+            embedding_model: The embedding model used to embed the incoming queries.
+            similarity_threshold (float): Minimum cosine similarity for a cache hit.
+            max_entries (int): Maximum number of cached answers.
+            ttl_seconds (float): Lifetime of an entry in seconds, None disables expiry.
+            version_provider (callable): Returns the current vectorstore version, the cache is cleared when it changes.
+            version_check_seconds (float): Minimum interval between two calls of the version provider.
+        """
+        self.embedding_model = embedding_model
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_provider = version_provider
+        self.version_check_seconds = version_check_seconds
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._entries = OrderedDict()
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self._version = self._current_version()
+        self._version_checked_at = time.monotonic()
+
+    def embed_query(self, query):
+        """Embeds and normalizes a query, so that a dot product equals the cosine similarity."""
+        return _normalize(self.embedding_model.embed_query(query))
+
+    def lookup(self, query, query_embedding=None):
+        """Returns the cached answer for a semantically similar query or None."""
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        else:
+            query_embedding = _normalize(query_embedding)
+
+        self._check_version()
+        with self._lock:
+            self._expire_entries()
+
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            slots = np.fromiter(self._entries.keys(), dtype=np.int64, count=len(self._entries))
+            similarities = self._vectors[slots] @ query_embedding
+            best = int(np.argmax(similarities))
+
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+
+            slot = int(slots[best])
+            self._entries.move_to_end(slot)
+            self.hits += 1
+            return self._entries[slot]["answer"]
+
+    def store(self, query, answer, query_embedding=None):
+        """Adds an answer to the cache, evicting the least recently used entry if the cache is full."""
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        else:
+            query_embedding = _normalize(query_embedding)
+
+        self._check_version()
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, query_embedding.shape[0]), dtype=np.float32)
+
+            if not self._free_slots:
+                evicted_slot, _ = self._entries.popitem(last=False)
+                self._free_slots.append(evicted_slot)
+
+            slot = self._free_slots.pop()
+            self._vectors[slot] = query_embedding
+            self._entries[slot] = {"query": query, "answer": answer, "created_at": time.monotonic()}
+
+    def invalidate(self):
+        """Removes all entries from the cache."""
+        with self._lock:
+            self._clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_version(self):
+        """
+        Clears the cache if the vectorstore version changed. The version provider usually reads a file, so it is
+        called at most every version_check_seconds and outside the lock, and a failing read keeps the cache.
+        """
+        if self.version_provider is None or time.monotonic() - self._version_checked_at < self.version_check_seconds:
+            return
+        self._version_checked_at = time.monotonic()
+
+        try:
+            version = self._current_version()
+        except (OSError, ValueError):
+            logging.warning("Could not read the vectorstore version, keeping the cached responses.", exc_info=True)
+            return
+
+        with self._lock:
+            if version != self._version:
+                self._clear()
+                self._version = version
+
+    def _current_version(self):
+        if self.version_provider is None:
+            return None
+        return self.version_provider()
+
+    def _expire_entries(self):
+        if self.ttl_seconds is None:
+            return
+
+        expiry_time = time.monotonic() - self.ttl_seconds
+        expired_slots = [slot for slot, entry in self._entries.items() if entry["created_at"] < expiry_time]
+        for slot in expired_slots:
+            del self._entries[slot]
+            self._free_slots.append(slot)
+
+    def _clear(self):
+        self._entries.clear()
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
@@ -0,0 +1,108 @@
+import json
+import os
+
+SYMBOL_TABLE_FILENAME = "symbol_table.json"
+
+
+class SymbolTable:
+    """
+    Links the chunks of the library by their symbols, so a retrieved chunk can be expanded to its parent
+    and sibling chunks by lookup instead of further vector searches.
+
+    Maps each class to the chunk IDs of its header and of each method, each module to its top-level
+    symbols, each apy_command to the chunk IDs of its implementation and each top-level function to
+    its chunk IDs. Classes are keyed by source path and class name, so equally named classes of
+    different modules are kept apart.
+    """
+
+    def __init__(self, classes=None, modules=None, commands=None, functions=None):
+        self.classes = classes if classes is not None else {}
+        self.modules = modules if modules is not None else {}
+        self.commands = commands if commands is not None else {}
+        self.functions = functions if functions is not None else {}
+
+    def collect(self, documents):
+        """Adds the chunks to the symbol table while passing them through, so it is built from the chunk stream."""
+        for doc in documents:
+            self.add_chunk(doc)
+            yield doc
+
+    def add_chunk(self, doc):
+        metadata = doc.metadata
+        chunk_id = metadata.get("chunk_id")
+        source = metadata.get("source")
+        chunk_type = metadata.get("type")
+        if chunk_id is None or source is None:
+            return
+
+        if "class" in metadata:
+            class_entry = self.classes.setdefault(_class_key(source, metadata["class"]), {"header": [], "methods": {}})
+            if chunk_type == "class":
+                class_entry["header"].append(chunk_id)
+                # Nested classes are listed under their outermost class
+                self._add_module_symbol(source, metadata["class"].split(".")[0])
+            else:
+                class_entry["methods"].setdefault(metadata["method"], []).append(chunk_id)
+        elif chunk_type == "command":
+            self.commands.setdefault(metadata["command"], []).append(chunk_id)
+            self._add_module_symbol(source, metadata["command"])
+        elif chunk_type == "function":
+            self.functions.setdefault(_function_key(source, metadata["method"]), []).append(chunk_id)
+            self._add_module_symbol(source, metadata["method"])
+
+    def related_chunk_ids(self, metadata, init_method="__init__"):
+        """
+        Returns the IDs of the chunks related to a chunk, in the order they should be added: the other pieces
+        of the same method, function or command and, for methods, the class header and the __init__ method.
+        """
+        chunk_id = metadata.get("chunk_id")
+        source = metadata.get("source")
+        related_ids = []
+
+        if "class" in metadata:
+            class_entry = self.classes.get(_class_key(source, metadata["class"]))
+            if class_entry is not None:
+                if "method" in metadata:
+                    related_ids.extend(class_entry["methods"].get(metadata["method"], []))
+                related_ids.extend(class_entry["header"])
+                related_ids.extend(class_entry["methods"].get(init_method, []))
+        elif "command" in metadata:
+            related_ids.extend(self.commands.get(metadata["command"], []))
+        elif "method" in metadata:
+            related_ids.extend(self.functions.get(_function_key(source, metadata["method"]), []))
+
+        return [related_id for related_id in dict.fromkeys(related_ids) if related_id != chunk_id]
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(
+                {"classes": self.classes, "modules": self.modules, "commands": self.commands, "functions": self.functions},
+                file,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as file:
+            data = json.load(file)
+        return cls(data["classes"], data["modules"], data["commands"], data["functions"])
+
+    def _add_module_symbol(self, source, symbol):
+        symbols = self.modules.setdefault(source, [])
+        if symbol not in symbols:
+            symbols.append(symbol)
+
+
+def load_symbol_table(vectorstore_path):
+    """Returns the symbol table shipped with the vectorstore, or None for vectorstores built without one."""
+    symbol_table_path = os.path.join(vectorstore_path, SYMBOL_TABLE_FILENAME)
+    if not os.path.exists(symbol_table_path):
+        return None
+    return SymbolTable.load(symbol_table_path)
+
+
+def _class_key(source, class_name):
+    return f"{source}::{class_name}"
+
+
+def _function_key(source, function_name):
+    return f"{source}::{function_name}"
@@ -0,0 +1,46 @@
+from functools import lru_cache
+
+from transformers import AutoTokenizer
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(tokenizer_name):
+    """Loads the (fast) Hugging Face tokenizer once per process and reuses it afterwards."""
+    return AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def count_tokens(text, tokenizer):
+    """Returns the number of tokens of the text, without special tokens."""
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def truncate_to_tokens(text, tokenizer, max_tokens):
+    """Cuts the text after max_tokens tokens."""
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+    if len(token_ids) <= max_tokens:
+        return text
+    return tokenizer.decode(token_ids[:max_tokens])
+
+
+class TokenLength:
+    """
+    Length function measuring texts in tokens of a Hugging Face tokenizer, for the chunk sizing.
+
+    Only the tokenizer name is pickled, so it can be passed to chunking worker processes, each of which
+    loads the tokenizer once. Token counts are cached, as code chunks are split line by line and many
+    lines, such as blank lines or returns, repeat throughout the code base.
+    """
+
+    def __init__(self, tokenizer_name):
+        self.tokenizer_name = tokenizer_name
+
+    def __call__(self, text):
+        return _count_tokens_cached(self.tokenizer_name, text)
+
+    def __repr__(self):
+        return f"TokenLength({self.tokenizer_name!r})"
+
+
+@lru_cache(maxsize=65536)
+def _count_tokens_cached(tokenizer_name, text):
+    return count_tokens(text, get_tokenizer(tokenizer_name))
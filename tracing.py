@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 95, 99)
+
+
+class Span:
+    """A single timed stage of a request, with attributes such as token counts, chunk counts or cache hits."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.attributes = {}
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    Records the duration and attributes of each stage of the RAG request path and keeps a rolling
+    window of durations per stage, from which the p50/p95/p99 latencies are computed.
+    """
+
+    def __init__(self, window_size=1000):
+        self.window_size = window_size
+
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._counters = {}
+
+    @contextmanager
+    def span(self, stage):
+        """Times the enclosed block as the given stage. Attributes can be added to the yielded span."""
+        span = Span(stage)
+        start_time = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - start_time
+            self.record(span)
+
+    def record(self, span):
+        with self._lock:
+            self._durations.setdefault(span.stage, deque(maxlen=self.window_size)).append(span.duration)
+
+            counters = self._counters.setdefault(span.stage, {})
+            counters["requests"] = counters.get("requests", 0) + 1
+            for name, value in span.attributes.items():
+                # Booleans such as cache_hit are counted, numbers are summed up
+                if isinstance(value, (bool, int, float)):
+                    counters[name] = counters.get(name, 0) + value
+
+        if logger.isEnabledFor(logging.DEBUG):
+            attributes = " ".join(f"{name}={value}" for name, value in span.attributes.items())
+            logger.debug(f"stage={span.stage} duration_ms={span.duration * 1000:.1f} {attributes}")
+
+    def stage_percentiles(self):
+        """Returns the p50/p95/p99 latencies in seconds and the number of samples of each stage."""
+        with self._lock:
+            durations_per_stage = {stage: sorted(durations) for stage, durations in self._durations.items()}
+
+        return {
+            stage: {
+                **{f"p{percentile}": _percentile(durations, percentile) for percentile in PERCENTILES},
+                "samples": len(durations),
+            }
+            for stage, durations in durations_per_stage.items()
+        }
+
+    def to_prometheus_text(self):
+        """Renders the latency percentiles and the counters in the Prometheus text exposition format."""
+        lines = [
+            "# HELP kadi_bot_stage_latency_seconds Rolling latency percentiles per request stage.",
+            "# TYPE kadi_bot_stage_latency_seconds summary",
+        ]
+        for stage, stats in self.stage_percentiles().items():
+            for percentile in PERCENTILES:
+                lines.append(
+                    f'kadi_bot_stage_latency_seconds{{stage="{stage}",quantile="{percentile / 100}"}} {stats[f"p{percentile}"]:.6f}'
+                )
+            lines.append(f'kadi_bot_stage_latency_seconds_count{{stage="{stage}"}} {stats["samples"]}')
+
+        with self._lock:
+            counters = {stage: dict(stage_counters) for stage, stage_counters in self._counters.items()}
+
+        lines.append("# HELP kadi_bot_stage_total Counters of the request stages and their attributes.")
+        lines.append("# TYPE kadi_bot_stage_total counter")
+        for stage, stage_counters in counters.items():
+            for name, value in stage_counters.items():
+                lines.append(f'kadi_bot_stage_total{{stage="{stage}",counter="{name}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+
+def token_usage(message):
+    """Returns the token counts reported by the LLM provider for a message, if any."""
+    usage_metadata = getattr(message, "usage_metadata", None)
+    if not usage_metadata:
+        return {}
+    return {
+        "input_tokens": usage_metadata.get("input_tokens", 0),
+        "output_tokens": usage_metadata.get("output_tokens", 0),
+    }
+
+
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(percentile / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
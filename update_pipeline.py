@@ -1,18 +1,30 @@
 from process_directory import extract_and_process_zip
-from chunking import chunk_pythoncode_and_add_metadata, chunk_text_and_add_metadata
-from embeddings import get_SFR_Code_embedding_model
+from chunking import iter_pythoncode_chunks, iter_text_chunks, iter_with_chunk_ids, ChunkLengthStats, LENGTH_UNITS
+from embeddings import get_SFR_Code_embedding_model, resolve_model_revision, BatchedEmbeddings, ParallelEmbeddings
+from token_counter import get_tokenizer, TokenLength
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from chunk_cache import ChunkCache
+from symbol_table import SymbolTable, SYMBOL_TABLE_FILENAME
 from gitlab_operations import download_gitlab_repo
 from gitlab_operations import get_latest_release_version_tag
 from config_loader import load_config
 from packaging.version import Version
-from huggingface_operations import upload_folder_to_huggingface, delete_folder_from_huggingface, check_folder_exists
+from huggingface_operations import upload_folder_to_huggingface, download_folder_from_huggingface, delete_folder_from_huggingface, check_folder_exists, get_folder_file_sizes, get_vectorstore_repo
 from langchain.vectorstores import Chroma
+from langchain.schema import Document
+from bm25_index import BM25Index, BM25_INDEX_FILENAME
+from vectorstore_manifest import write_manifest, read_manifest, MANIFEST_FILENAME
+from vectorstore import get_compact_embedding_model, FlatVectorStore, FLAT_INDEX_DIRNAME, VECTORSTORE_BACKENDS
+from library_usage_router import CentroidUsageRouter, USAGE_CENTROIDS_FILENAME
 from datetime import datetime, timedelta, timezone
+from itertools import chain, islice
+import numpy as np
 import time
 import tempfile
 import json
 import shutil
 import logging
+import os
   
 class UpdatePipeline:
 
@@ -53,22 +65,52 @@ class UpdatePipeline:
             kadiAPY_library_files_content, kadiAPY_library_files_path = self.get_kadiAPY_library_dataset(target_path_zip_file)
             logging.info(f"Number of library files extracted: {len(kadiAPY_library_files_content)}")
 
-            logging.info("Chunking KadiAPY documentation files.")
-            kadiAPY_doc_documents = self.chunk_kadiAPY_doc_dataset(kadiAPY_doc_files_content, kadiAPY_doc_files_path)
-            logging.info(f"Number of document chunks created: {len(kadiAPY_doc_documents)}")
-            
-            logging.info("Chunking KadiAPY library files.")
-            kadiAPY_library_documents = self.chunk_kadiAPY_library_files_dataset(kadiAPY_library_files_content, kadiAPY_library_files_path)
-            logging.info(f"Number of library chunks created: {len(kadiAPY_library_documents)}")
+        # The chunks are produced lazily while they are embedded, the documentation first and then the library
+        chunk_cache = ChunkCache(self.dataset_params["chunking"]["cache_directory"])
+        # The symbol table linking the chunks of each class, command and function is filled from the same stream
+        symbol_table = SymbolTable()
+        chunk_length_stats = self.get_chunk_length_stats()
+        documents = chunk_length_stats.collect(symbol_table.collect(iter_with_chunk_ids(chain(
+            self.chunk_kadiAPY_doc_dataset(kadiAPY_doc_files_content, kadiAPY_doc_files_path, chunk_cache),
+            self.chunk_kadiAPY_library_files_dataset(kadiAPY_library_files_content, kadiAPY_library_files_path, chunk_cache),
+        ))))
 
         # creating temporary directory to avoid persisting vectorstore files on disk        
         temp_dir2 = tempfile.mkdtemp()
         logging.info(f"Temporary directory created for vectorstore: {temp_dir2}")
         
-        logging.info("Embedding documents into vectorstore starting.")
-        self.embed_documents_into_vectorstore(kadiAPY_doc_documents + kadiAPY_library_documents, get_SFR_Code_embedding_model(), temp_dir2)
+        vectorstore_backend = self.get_vectorstore_backend()
+        if vectorstore_backend == "chroma" and self.dataset_params["embedding"].get("vector_dtype", "float32") == "float16":
+            logging.warning("Chroma stores float32 vectors, so float16 vectors are only rounded there. Use the flat backend to store them as float16.")
+        logging.info(f"Chunking the KadiAPY documentation and library files and embedding them into the {vectorstore_backend} vectorstore.")
+        embedding_model = self.get_embedding_model()
+        try:
+            # Only the backend the app serves from is built and uploaded
+            if vectorstore_backend == "flat":
+                new_vectorstore = self.build_flat_index(documents, embedding_model, temp_dir2)
+            else:
+                new_vectorstore = self.embed_documents_into_vectorstore(documents, embedding_model, temp_dir2)
+        finally:
+            if isinstance(embedding_model, ParallelEmbeddings):
+                embedding_model.close()
+        chunk_cache.log_stats()
+        chunk_length_stats.log_stats()
+
+        logging.info("Writing the symbol table next to the vectorstore.")
+        symbol_table.save(os.path.join(temp_dir2, SYMBOL_TABLE_FILENAME))
         logging.info("Embedding documents into vectorstore finished.")
 
+        logging.info("Computing library usage centroids for the local usage router.")
+        self.build_usage_router(new_vectorstore, temp_dir2)
+
+        logging.info("Building BM25 index next to the vectorstore.")
+        self.build_lexical_index(new_vectorstore, temp_dir2)
+
+        logging.info("Writing the vectorstore manifest.")
+        self.write_vectorstore_manifest(temp_dir2, version_number)
+
+        self.log_vectorstore_size(temp_dir2)
+
         logging.info("Deleting existing vectorstore folder from Hugging Face.")
         self.delete_vectorstore_folder_from_huggingface()
         
@@ -92,7 +134,7 @@ class UpdatePipeline:
         new_entry = {
             "update_date": local_time,
             "project_release_version": version_number,
-            "deployed_to_hf_repo": self.gitlab_hf_settings["huggingface_parameters"]["hf_repo_id"]
+            "deployed_to_hf_repo": get_vectorstore_repo(self.gitlab_hf_settings["huggingface_parameters"])[0]
         }
 
         try:
@@ -108,43 +150,321 @@ class UpdatePipeline:
 
         print(f"Updated vectorstore history with version: {version_number}")
 
+    def log_vectorstore_size(self, persist_directory):
+        """Logs the on-disk size of each file and index directory of the new and of the deployed vectorstore."""
+        hf_repo_id, hf_repo_type = get_vectorstore_repo(self.gitlab_hf_settings["huggingface_parameters"])
+        hf_vectorstore_path = self.gitlab_hf_settings["huggingface_parameters"]["hf_vectorstore_path"]
+
+        new_file_sizes = {
+            os.path.relpath(os.path.join(root, filename), persist_directory): os.path.getsize(os.path.join(root, filename))
+            for root, _, filenames in os.walk(persist_directory)
+            for filename in filenames
+        }
+        new_sizes = _component_sizes(new_file_sizes)
+        deployed_sizes = _component_sizes(get_folder_file_sizes(hf_vectorstore_path, hf_repo_id, hf_repo_type))
+
+        for component in sorted(set(new_sizes).union(deployed_sizes)):
+            logging.info(
+                f"Vectorstore size of {component}: {_format_size(new_sizes.get(component))} "
+                f"(deployed: {_format_size(deployed_sizes.get(component))})"
+            )
+        logging.info(
+            f"Vectorstore size: {_format_size(sum(new_sizes.values()))} "
+            f"(deployed: {_format_size(sum(deployed_sizes.values()) if deployed_sizes else None)})"
+        )
+
     def delete_vectorstore_folder_from_huggingface(self):
-        hf_repo_id = self.gitlab_hf_settings["huggingface_parameters"]["hf_repo_id"]
-        hf_repo_type = self.gitlab_hf_settings["huggingface_parameters"]["hf_repo_type"]
+        hf_repo_id, hf_repo_type = get_vectorstore_repo(self.gitlab_hf_settings["huggingface_parameters"])
         hf_vectorstore_path = self.gitlab_hf_settings["huggingface_parameters"]["hf_vectorstore_path"]
 
-        if check_folder_exists(hf_repo_id, hf_vectorstore_path):
+        if check_folder_exists(hf_repo_id, hf_vectorstore_path, hf_repo_type):
             delete_folder_from_huggingface(hf_vectorstore_path, hf_repo_id, hf_repo_type)
         else:
             print(f"Skipping deletion: Folder '{hf_vectorstore_path}' does not exist in repository '{hf_repo_id}'.")
 
     def upload_folder_to_hf(self, temp_dir):
-        hf_repo_id = self.gitlab_hf_settings["huggingface_parameters"]["hf_repo_id"]
-        hf_repo_type = self.gitlab_hf_settings["huggingface_parameters"]["hf_repo_type"]
+        hf_repo_id, hf_repo_type = get_vectorstore_repo(self.gitlab_hf_settings["huggingface_parameters"])
         hf_vectorstore_path = self.gitlab_hf_settings["huggingface_parameters"]["hf_vectorstore_path"]
         upload_folder_to_huggingface(temp_dir, hf_repo_id, hf_repo_type, hf_vectorstore_path)
 
+    def get_embedding_model(self):
+        """
+        Returns the length-bucketed embedding model for the index build, pinned to a resolved revision so cached
+        embeddings stay valid. With more than one worker the batches are embedded in a process pool.
+        """
+        embedding_params = self.dataset_params["embedding"]
+        model_name = embedding_params["model_name"]
+        self.embedding_model_revision = resolve_model_revision(model_name, embedding_params.get("model_revision"))
+        backend = embedding_params.get("backend", "fp32")
+        num_workers = embedding_params.get("num_workers", 1)
+        logging.info(f"Using embedding model {model_name} ({backend}) at revision {self.embedding_model_revision} with {num_workers} worker(s).")
+
+        batching_params = {
+            "tokenizer": get_tokenizer(model_name),
+            "batch_size": embedding_params["batch_size"],
+            "max_batch_tokens": embedding_params["max_batch_tokens"],
+        }
+        if num_workers > 1:
+            return ParallelEmbeddings(
+                model_name,
+                revision=self.embedding_model_revision,
+                backend=backend,
+                num_workers=num_workers,
+                torch_threads_per_worker=embedding_params["torch_threads_per_worker"],
+                **batching_params,
+            )
+
+        embedding_model = get_SFR_Code_embedding_model(model_name, revision=self.embedding_model_revision, backend=backend)
+        return BatchedEmbeddings(embedding_model, **batching_params)
+
+    def get_vectorstore_backend(self):
+        backend = self.dataset_params.get("vectorstore", {}).get("backend", "chroma")
+        if backend not in VECTORSTORE_BACKENDS:
+            raise ValueError(f"Unknown vectorstore backend: {backend}, expected one of {VECTORSTORE_BACKENDS}")
+        return backend
+
+    def get_cached_embedding_models(self, embedding_model):
+        """
+        Returns the embedding cache, the embedding model reading through it and the compact embedding model on
+        top producing the stored vectors. Only the cache misses reach the embedding model, the cache keeps the
+        full-precision vectors.
+        """
+        embedding_params = self.dataset_params["embedding"]
+        embedding_cache = EmbeddingCache(
+            embedding_params["cache_directory"],
+            embedding_params["model_name"],
+            self.embedding_model_revision,
+            embedding_params.get("backend", "fp32"),
+        )
+        cached_embedding_model = CachedEmbeddings(embedding_model, embedding_cache)
+        compact_embedding_model = get_compact_embedding_model(
+            cached_embedding_model, embedding_params.get("vector_dimension"), embedding_params.get("vector_dtype", "float32")
+        )
+        return embedding_cache, cached_embedding_model, compact_embedding_model
+
     def embed_documents_into_vectorstore(self, documents, embedding_model, persist_directory):
-        new_vectorstore = Chroma(persist_directory=persist_directory, embedding_function=embedding_model)
-        new_vectorstore.add_documents(documents)
+        """
+        Builds the vectorstore in persist_directory from the stream of chunks with chunk IDs, batch by batch, so
+        embedding starts with the first chunks and the chunks are not all held in memory. If the vectorstore
+        deployed on Hugging Face was built with the same embedding settings, it is downloaded and only updated:
+        chunks with a new ID are added, chunks whose ID is gone are deleted and kept chunks with changed metadata
+        are replaced, so the build time scales with the changes of the release.
+        """
+        embedding_cache, cached_embedding_model, compact_embedding_model = self.get_cached_embedding_models(embedding_model)
+
+        with tempfile.TemporaryDirectory() as download_dir:
+            previous_vectorstore_path = self.download_reusable_vectorstore(download_dir, "chroma")
+            if previous_vectorstore_path:
+                shutil.copytree(previous_vectorstore_path, persist_directory, dirs_exist_ok=True)
+                logging.info("Updating the downloaded previous vectorstore incrementally.")
+
+        new_vectorstore = Chroma(persist_directory=persist_directory, embedding_function=compact_embedding_model)
+        existing_data = new_vectorstore.get(include=["metadatas"])
+        existing_metadatas = dict(zip(existing_data["ids"], existing_data["metadatas"]))
+
+        chunk_ids = set()
+        number_of_new_chunks = 0
+        number_of_moved_chunks = 0
+        stream_batch_size = self.dataset_params["chunking"]["stream_batch_size"]
+        for batch in _batched(documents, stream_batch_size):
+            chunk_ids.update(doc.metadata["chunk_id"] for doc in batch)
+            new_documents = [doc for doc in batch if doc.metadata["chunk_id"] not in existing_metadatas]
+            # Chunk IDs do not depend on the position in the file, so a kept chunk whose metadata changed,
+            # e.g. because lines were inserted above it, is replaced. Its vector comes from the embedding cache.
+            moved_documents = [
+                doc for doc in batch
+                if doc.metadata["chunk_id"] in existing_metadatas and existing_metadatas[doc.metadata["chunk_id"]] != doc.metadata
+            ]
+            if moved_documents:
+                new_vectorstore.delete(ids=[doc.metadata["chunk_id"] for doc in moved_documents])
+                number_of_moved_chunks += len(moved_documents)
+            if new_documents or moved_documents:
+                changed_documents = new_documents + moved_documents
+                new_vectorstore.add_documents(changed_documents, ids=[doc.metadata["chunk_id"] for doc in changed_documents])
+                number_of_new_chunks += len(new_documents)
+
+        stale_ids = set(existing_metadatas).difference(chunk_ids)
+        if stale_ids:
+            new_vectorstore.delete(ids=list(stale_ids))
+        logging.info(
+            f"Vectorstore update: {len(chunk_ids)} chunks, {len(chunk_ids) - number_of_new_chunks} kept "
+            f"({number_of_moved_chunks} with updated metadata), {len(stale_ids)} deleted, {number_of_new_chunks} added."
+        )
+
+        embedding_cache.save()
+        cached_embedding_model.log_stats()
+        return new_vectorstore
+
+    def build_flat_index(self, documents, embedding_model, persist_directory):
+        """
+        Builds the flat index in persist_directory from the stream of chunks with chunk IDs, without a Chroma store
+        in between. If the flat index deployed on Hugging Face was built with the same embedding settings, the
+        vectors of the kept chunks are taken from it and only the new chunks are embedded.
+        """
+        embedding_cache, cached_embedding_model, compact_embedding_model = self.get_cached_embedding_models(embedding_model)
+
+        ids, page_contents, metadatas, vectors = [], [], [], []
+        number_of_new_chunks = 0
+        stream_batch_size = self.dataset_params["chunking"]["stream_batch_size"]
+        # The previous index is memory-mapped from its own download directory while the new one is written
+        with tempfile.TemporaryDirectory() as download_dir:
+            previous_vectorstore_path = self.download_reusable_vectorstore(download_dir, "flat")
+            previous_index = None
+            if previous_vectorstore_path:
+                previous_index = FlatVectorStore.load(os.path.join(previous_vectorstore_path, FLAT_INDEX_DIRNAME), None)
+                logging.info("Reusing the vectors of the kept chunks from the downloaded previous flat index.")
+
+            for batch in _batched(documents, stream_batch_size):
+                previous_rows = [
+                    previous_index.row_of(doc.metadata["chunk_id"]) if previous_index else None for doc in batch
+                ]
+                new_documents = [doc for doc, row in zip(batch, previous_rows) if row is None]
+                new_vectors = iter(compact_embedding_model.embed_documents([doc.page_content for doc in new_documents]))
+                for doc, row in zip(batch, previous_rows):
+                    ids.append(doc.metadata["chunk_id"])
+                    page_contents.append(doc.page_content)
+                    metadatas.append(doc.metadata)
+                    vectors.append(next(new_vectors) if row is None else np.array(previous_index.vectors[row], dtype=np.float32))
+                number_of_new_chunks += len(new_documents)
+
+            number_of_deleted_chunks = len(previous_index.ids) - (len(ids) - number_of_new_chunks) if previous_index else 0
+            logging.info(
+                f"Flat index update: {len(ids)} chunks, {len(ids) - number_of_new_chunks} kept, "
+                f"{number_of_deleted_chunks} deleted, {number_of_new_chunks} added."
+            )
+
+            vector_dtype = self.dataset_params["embedding"].get("vector_dtype", "float32")
+            flat_index_path = os.path.join(persist_directory, FLAT_INDEX_DIRNAME)
+            FlatVectorStore.export(flat_index_path, ids, page_contents, metadatas, vectors, vector_dtype)
 
-    def chunk_kadiAPY_doc_dataset(self, doc_files_content, doc_files_path):
+        embedding_cache.save()
+        cached_embedding_model.log_stats()
+        return FlatVectorStore.load(flat_index_path, compact_embedding_model)
+
+    def download_reusable_vectorstore(self, download_dir, vectorstore_backend):
+        """
+        Downloads the vectorstore deployed on Hugging Face into download_dir if incremental updates are enabled
+        and it was built with the current embedding settings and vectorstore backend. Only its manifest is
+        downloaded first, so nothing else is fetched if the vectorstore has to be rebuilt from scratch anyway.
+
+        Returns:
+            str: The path of the downloaded previous vectorstore, or None if it is rebuilt from scratch.
+        """
+        if not self.dataset_params.get("incremental_update", {}).get("enabled", False):
+            return None
+
+        hf_repo_id, hf_repo_type = get_vectorstore_repo(self.gitlab_hf_settings["huggingface_parameters"])
+        hf_vectorstore_path = self.gitlab_hf_settings["huggingface_parameters"]["hf_vectorstore_path"]
+
+        previous_vectorstore_path = download_folder_from_huggingface(
+            hf_vectorstore_path, hf_repo_id, hf_repo_type, download_dir, allow_patterns=[MANIFEST_FILENAME]
+        )
+        previous_manifest = read_manifest(previous_vectorstore_path)
+        if not previous_manifest:
+            logging.info("No deployed vectorstore with a manifest found, building it from scratch.")
+            return None
+        if previous_manifest != {**previous_manifest, **self.get_embedding_manifest(), "vectorstore_backend": vectorstore_backend}:
+            logging.info("The deployed vectorstore was built with other embedding settings or another backend, rebuilding it from scratch.")
+            return None
+
+        # The BM25 index, usage centroids and symbol table are rebuilt from the updated vectorstore
+        if vectorstore_backend == "flat":
+            download_folder_from_huggingface(
+                hf_vectorstore_path, hf_repo_id, hf_repo_type, download_dir, allow_patterns=[f"{FLAT_INDEX_DIRNAME}/*"]
+            )
+        else:
+            download_folder_from_huggingface(
+                hf_vectorstore_path, hf_repo_id, hf_repo_type, download_dir, ignore_patterns=[f"{FLAT_INDEX_DIRNAME}/*"]
+            )
+        return previous_vectorstore_path
+
+    def get_embedding_manifest(self):
+        embedding_params = self.dataset_params["embedding"]
+        return {
+            "embedding_model": embedding_params["model_name"],
+            "embedding_model_revision": self.embedding_model_revision,
+            "embedding_backend": embedding_params.get("backend", "fp32"),
+            "vector_dimension": embedding_params.get("vector_dimension"),
+            "vector_dtype": embedding_params.get("vector_dtype", "float32"),
+        }
+
+    def write_vectorstore_manifest(self, persist_directory, version_number):
+        """
+        Records the embedding model the vectorstore was built with, so the app embeds queries the same way. The
+        build time tells the hot-swapping app apart two builds of the same release.
+        """
+        write_manifest(persist_directory, {
+            "project_release_version": version_number,
+            "build_time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "vectorstore_backend": self.get_vectorstore_backend(),
+            **self.get_embedding_manifest(),
+        })
+
+    def build_lexical_index(self, vectorstore, persist_directory):
+        stored_data = vectorstore.get(include=["documents", "metadatas"])
+        documents = [
+            Document(page_content=page_content, metadata=metadata)
+            for page_content, metadata in zip(stored_data["documents"], stored_data["metadatas"])
+        ]
+        lexical_index = BM25Index.from_documents(documents)
+        lexical_index.save(os.path.join(persist_directory, BM25_INDEX_FILENAME))
+        logging.info(f"BM25 index built with {len(lexical_index.idf)} terms over {len(documents)} chunks.")
+
+    def build_usage_router(self, vectorstore, persist_directory):
+        stored_data = vectorstore.get(include=["embeddings", "metadatas"])
+        usage_router = CentroidUsageRouter.from_embeddings(stored_data["embeddings"], stored_data["metadatas"])
+        usage_router.save(os.path.join(persist_directory, USAGE_CENTROIDS_FILENAME))
+        logging.info(f"Usage centroids computed for: {', '.join(usage_router.usages)}")
+
+    def chunk_kadiAPY_doc_dataset(self, doc_files_content, doc_files_path, chunk_cache=None):
         doc_params = self.dataset_params["datasets"]["kadi_apy_docs"]
-        chunk_size = doc_params["chunking"]["chunking_size"]
-        chunk_overlap = doc_params["chunking"]["chunking_overlap"]
+        chunk_size = self.get_chunk_size(doc_params["chunking"], "chunking_size")
+        chunk_overlap = self.get_chunk_size(doc_params["chunking"], "chunking_overlap")
         dataset_name = doc_params["dataset"]
-        kadiAPY_doc_documents = chunk_text_and_add_metadata(doc_files_content, doc_files_path, chunk_size, chunk_overlap)
-        self.add_dataset_metadata(kadiAPY_doc_documents, dataset_name)
-        return kadiAPY_doc_documents
+        num_workers = self.dataset_params["chunking"]["num_workers"]
+        kadiAPY_doc_documents = iter_text_chunks(
+            doc_files_content, doc_files_path, chunk_size, chunk_overlap, num_workers, chunk_cache, self.get_chunk_length_function()
+        )
+        return self.add_dataset_metadata(kadiAPY_doc_documents, dataset_name)
 
-    def chunk_kadiAPY_library_files_dataset(self, kadiAPY_library_files_content, kadiAPY_library_files_content_path):
+    def chunk_kadiAPY_library_files_dataset(self, kadiAPY_library_files_content, kadiAPY_library_files_content_path, chunk_cache=None):
         library_params = self.dataset_params["datasets"]["kadi_apy_source_code"]
+        max_chunk_size = self.get_chunk_size(library_params["chunking"], "max_chunk_size")
         dataset_name = library_params["dataset"]
-        kadiAPY_library_documents = chunk_pythoncode_and_add_metadata(kadiAPY_library_files_content, kadiAPY_library_files_content_path, 1024)
-        self.add_dataset_metadata(kadiAPY_library_documents, dataset_name)
-        return kadiAPY_library_documents
+        num_workers = self.dataset_params["chunking"]["num_workers"]
+        kadiAPY_library_documents = iter_pythoncode_chunks(
+            kadiAPY_library_files_content, kadiAPY_library_files_content_path, max_chunk_size, num_workers, chunk_cache, self.get_chunk_length_function()
+        )
+        return self.add_dataset_metadata(kadiAPY_library_documents, dataset_name)
     
 
+    def get_chunk_length_function(self):
+        """Returns the length function of the chunk sizing, counting characters or tokens of the chunking tokenizer."""
+        chunking_params = self.dataset_params["chunking"]
+        length_unit = chunking_params["length_unit"]
+        if length_unit not in LENGTH_UNITS:
+            raise ValueError(f"Unknown chunk length unit: {length_unit}, expected one of {LENGTH_UNITS}")
+
+        if length_unit == "tokens":
+            return TokenLength(chunking_params["tokenizer"])
+        return len
+
+    def get_chunk_size(self, chunking_params, name):
+        """Returns the chunk size parameter in the configured length unit, e.g. chunking_size or chunking_size_tokens."""
+        if self.dataset_params["chunking"]["length_unit"] == "tokens":
+            return chunking_params[f"{name}_tokens"]
+        return chunking_params[name]
+
+    def get_chunk_length_stats(self):
+        """Measures the chunks in tokens of the embedding model, against the token limit of its tokenizer."""
+        model_name = self.dataset_params["embedding"]["model_name"]
+        tokenizer = get_tokenizer(model_name)
+        # Tokenizers without a limit report a huge sentinel value instead
+        max_length = tokenizer.model_max_length if tokenizer.model_max_length < 1_000_000 else None
+        if max_length is not None:
+            max_length -= tokenizer.num_special_tokens_to_add()
+        return ChunkLengthStats(TokenLength(model_name), max_length)
+
     def get_kadiAPY_doc_dataset(self, repo_zip_filepath):
         doc_params = self.dataset_params["datasets"]["kadi_apy_docs"]
         directories_of_kadi_apy_docs = doc_params.get("folder", [])
@@ -156,10 +476,10 @@ class UpdatePipeline:
         return extract_and_process_zip(directory_of_kadi_apy_library_source_code, repo_zip_filepath, filter_filetypes=["py"])
 
     def add_dataset_metadata(self, documents, dataset_name):
+        """Yields the chunks with their dataset category added."""
         for doc in documents:
             doc.metadata["dataset_category"] = dataset_name
-
-        return documents
+            yield doc
 
     def get_deployed_vectorstore_version_tag(self):
         """Read the used gitlab_project_version from the first entry in the JSON file."""
@@ -196,5 +516,22 @@ class UpdatePipeline:
             "target_path_zip_file": target_path_zip_file,
             "version_number": latest_release_version_tag
         }
-    
-    
\ No newline at end of file
+
+
+def _batched(iterable, batch_size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def _component_sizes(file_sizes):
+    """Sums up the file sizes per top-level file or directory of the vectorstore, e.g. flat_index."""
+    sizes = {}
+    for path, size in file_sizes.items():
+        component = path.replace(os.sep, "/").split("/")[0]
+        sizes[component] = sizes.get(component, 0) + size
+    return sizes
+
+
+def _format_size(size):
+    return "-" if size is None else f"{size / 2**20:.2f} MiB"
@@ -1,13 +1,342 @@
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+import numpy as np
+import json
+import logging
+import os
+from bisect import bisect_left
 
-def setup_vectorstore(docs, embedding_model,  persist_directory,):
+from embeddings import get_SFR_Code_embedding_model
+from metadata_filter import matches_filter, MetadataPartitions
+from vectorstore_manifest import read_manifest, write_manifest
+
+VECTOR_DTYPES = ("float32", "float16")
+VECTORSTORE_BACKENDS = ("chroma", "flat")
+FLAT_INDEX_DIRNAME = "flat_index"
+CHROMA_FILENAME = "chroma.sqlite3"
+
+
+def setup_vectorstore(docs, embedding_model,  persist_directory, vector_dimension=None, vector_dtype="float32"):
     print("Start setup_vectorstore_function")
-    vectorstore = get_chroma_vectorstore(embedding_model, persist_directory)
+    embedding_model = get_compact_embedding_model(embedding_model, vector_dimension, vector_dtype)
+    vectorstore = Chroma(persist_directory=persist_directory, embedding_function=embedding_model)
     vectorstore.add_documents(docs)
+    write_manifest(persist_directory, {
+        **read_manifest(persist_directory),
+        "vector_dimension": vector_dimension,
+        "vector_dtype": vector_dtype,
+    })
     return vectorstore
 
 def get_chroma_vectorstore(embedding_model, vectorstore_path):
+    manifest = read_manifest(vectorstore_path)
+    embedding_model = get_compact_embedding_model(
+        embedding_model, manifest.get("vector_dimension"), manifest.get("vector_dtype", "float32")
+    )
     vectorstore = Chroma(persist_directory=vectorstore_path, embedding_function=embedding_model)
     
-    return vectorstore
\ No newline at end of file
+    return vectorstore
+
+
+def get_vectorstore(embedding_model, vectorstore_path, backend="chroma"):
+    """
+    Opens the vectorstore for serving. The update pipeline only uploads one backend, so if the requested
+    backend is missing, the other one is opened instead.
+    """
+    if backend not in VECTORSTORE_BACKENDS:
+        raise ValueError(f"Unknown vectorstore backend: {backend}, expected one of {VECTORSTORE_BACKENDS}")
+
+    flat_index_path = os.path.join(vectorstore_path, FLAT_INDEX_DIRNAME)
+    has_flat_index = os.path.exists(flat_index_path)
+    has_chroma = os.path.exists(os.path.join(vectorstore_path, CHROMA_FILENAME))
+    if backend == "flat" and not has_flat_index and has_chroma:
+        logging.warning(f"No flat index found at {flat_index_path}, using Chroma instead.")
+        backend = "chroma"
+    elif backend == "chroma" and not has_chroma and has_flat_index:
+        logging.warning(f"No Chroma store found at {vectorstore_path}, using the flat index instead.")
+        backend = "flat"
+
+    if backend == "flat":
+        manifest = read_manifest(vectorstore_path)
+        embedding_model = get_compact_embedding_model(
+            embedding_model, manifest.get("vector_dimension"), manifest.get("vector_dtype", "float32")
+        )
+        return FlatVectorStore.load(flat_index_path, embedding_model)
+
+    return get_chroma_vectorstore(embedding_model, vectorstore_path)
+
+
+def get_query_embedding_model(vectorstore_path):
+    """Loads the embedding model the way the vectorstore was built, so query and index vectors are comparable."""
+    manifest = read_manifest(vectorstore_path)
+    if not manifest:
+        return get_SFR_Code_embedding_model()
+
+    embedding_model = get_SFR_Code_embedding_model(
+        manifest["embedding_model"],
+        revision=manifest["embedding_model_revision"],
+        backend=manifest["embedding_backend"],
+    )
+    return get_compact_embedding_model(embedding_model, manifest.get("vector_dimension"), manifest.get("vector_dtype", "float32"))
+
+
+def get_compact_embedding_model(embedding_model, vector_dimension=None, vector_dtype="float32"):
+    """
+    Wraps the embedding model so its vectors match a compact index. Returns the model unchanged for
+    full-precision indexes or if it is already wrapped with the same options.
+    """
+    if vector_dimension is None and vector_dtype == "float32":
+        return embedding_model
+    if isinstance(embedding_model, CompactEmbeddings):
+        if (embedding_model.vector_dimension, embedding_model.vector_dtype) == (vector_dimension, vector_dtype):
+            return embedding_model
+        embedding_model = embedding_model.embedding_model
+    return CompactEmbeddings(embedding_model, vector_dimension, vector_dtype)
+
+
+def compact_vectors(vectors, vector_dimension=None, vector_dtype="float32"):
+    """
+    Truncates the vectors to their first vector_dimension components, renormalizes them to unit length
+    and casts them to vector_dtype.
+    """
+    if vector_dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unknown vector dtype: {vector_dtype}, expected one of {VECTOR_DTYPES}")
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vector_dimension is not None:
+        vectors = vectors[..., :vector_dimension]
+
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(vector_dtype)
+
+
+class CompactEmbeddings(Embeddings):
+    """
+    Embedding model wrapper producing truncated, renormalized and optionally float16-rounded vectors.
+    Documents and queries have to go through the same wrapper to stay comparable.
+    """
+
+    def __init__(self, embedding_model, vector_dimension=None, vector_dtype="float32"):
+        self.embedding_model = embedding_model
+        self.vector_dimension = vector_dimension
+        self.vector_dtype = vector_dtype
+
+    def embed_documents(self, texts):
+        embeddings = self.embedding_model.embed_documents(texts)
+        if not embeddings:
+            return []
+        return self._compact(embeddings).tolist()
+
+    def embed_query(self, text):
+        return self._compact([self.embedding_model.embed_query(text)])[0].tolist()
+
+    def _compact(self, embeddings):
+        # Chroma only stores float32 vectors, so float16 vectors are rounded here and returned as float32.
+        # Only the flat index stores them as float16 on disk.
+        return compact_vectors(embeddings, self.vector_dimension, self.vector_dtype).astype(np.float32)
+
+
+
+class FlatVectorStore(VectorStore):
+    """
+    Read-only vectorstore for serving, holding the unit-length vectors as one memory-mapped matrix.
+
+    The matrix is stored in vectors.npy in its native dtype and opened with mmap_mode="r", so worker
+    processes share its pages instead of each holding a copy. The chunk IDs, the page contents and the
+    metadata (as one JSON object per chunk) are stored the same way, each as one UTF-8 blob with an array of
+    row offsets, and are only decoded for the rows a search returns. The posting lists of the metadata
+    partitions are precomputed at export time. Searches are exact: the similarities are one matrix product
+    and the top k are selected with np.argpartition.
+    """
+
+    VECTORS_FILENAME = "vectors.npy"
+    IDS_FILENAME = "ids"
+    ID_ORDER_FILENAME = "id_order.npy"
+    DOCUMENTS_FILENAME = "documents"
+    METADATA_FILENAME = "metadata"
+
+    def __init__(self, vectors, ids, id_order, documents, metadatas, partitions, embedding_model):
+        """
+        Parameters:
+            vectors: The (memory-mapped) matrix of the unit-length vectors, one row per chunk.
+            ids, documents, metadatas (StringBlob): The chunk IDs, page contents and JSON metadata per row.
+            id_order: The rows sorted by chunk ID, to look up chunks by ID with a binary search.
+            partitions (MetadataPartitions): The posting lists of the metadata partition fields.
+        """
+        self.vectors = vectors
+        self.ids = ids
+        self.id_order = id_order
+        self.documents = documents
+        self.metadatas = metadatas
+        self.embedding_model = embedding_model
+        # Filtered searches only score the rows of the matching usage, dataset_category and type partitions
+        self.partitions = partitions
+
+    @property
+    def embeddings(self):
+        return self.embedding_model
+
+    @classmethod
+    def export(cls, directory, ids, documents, metadatas, embeddings, vector_dtype="float32"):
+        """Writes the flat index files, the vectors are normalized and stored as vector_dtype."""
+        if vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Unknown vector dtype: {vector_dtype}, expected one of {VECTOR_DTYPES}")
+        os.makedirs(directory, exist_ok=True)
+
+        vectors = compact_vectors(embeddings, vector_dtype=vector_dtype)
+        with open(os.path.join(directory, cls.VECTORS_FILENAME), "wb") as file:
+            np.save(file, vectors)
+
+        ids = list(ids)
+        metadatas = [
+            {field: value for field, value in (metadata or {}).items() if value is not None} for metadata in metadatas
+        ]
+        StringBlob.write(os.path.join(directory, cls.IDS_FILENAME), ids)
+        np.save(os.path.join(directory, cls.ID_ORDER_FILENAME), np.asarray(sorted(range(len(ids)), key=ids.__getitem__), dtype=np.int64))
+        StringBlob.write(os.path.join(directory, cls.DOCUMENTS_FILENAME), documents)
+        StringBlob.write(
+            os.path.join(directory, cls.METADATA_FILENAME), (json.dumps(metadata, separators=(",", ":")) for metadata in metadatas)
+        )
+        MetadataPartitions.from_metadatas(metadatas).save(directory)
+
+        logging.info(f"Flat index written with {len(vectors)} {vector_dtype} vectors of dimension {vectors.shape[1]}.")
+
+    @classmethod
+    def export_from_chroma(cls, chroma_vectorstore, directory, vector_dtype="float32"):
+        stored_data = chroma_vectorstore.get(include=["documents", "metadatas", "embeddings"])
+        cls.export(
+            directory,
+            stored_data["ids"],
+            stored_data["documents"],
+            stored_data["metadatas"],
+            stored_data["embeddings"],
+            vector_dtype,
+        )
+
+    @classmethod
+    def load(cls, directory, embedding_model):
+        """Memory-maps the index files, only the small JSON file of the partition ranges is read."""
+        return cls(
+            np.load(os.path.join(directory, cls.VECTORS_FILENAME), mmap_mode="r"),
+            StringBlob.load(os.path.join(directory, cls.IDS_FILENAME)),
+            np.load(os.path.join(directory, cls.ID_ORDER_FILENAME), mmap_mode="r"),
+            StringBlob.load(os.path.join(directory, cls.DOCUMENTS_FILENAME)),
+            StringBlob.load(os.path.join(directory, cls.METADATA_FILENAME)),
+            MetadataPartitions.load(directory),
+            embedding_model,
+        )
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("FlatVectorStore is read-only, use FlatVectorStore.export to build it.")
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("FlatVectorStore is read-only, use FlatVectorStore.export to build it.")
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(self.embedding_model.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embedding_model.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None):
+        """Returns the k most cosine-similar documents matching the filter with their similarities, best first."""
+        rows = self._filter_rows(filter)
+        if len(rows) == 0 or k <= 0:
+            return []
+
+        query_vector = np.asarray(embedding, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+        similarities = self._similarities(rows, query_vector)
+
+        k = min(k, len(similarities))
+        top_k = np.argpartition(-similarities, k - 1)[:k]
+        top_k = top_k[np.argsort(-similarities[top_k])]
+        return [(self._document(int(rows[index])), float(similarities[index])) for index in top_k]
+
+    def get(self, ids=None, include=("documents", "metadatas")):
+        """
+        Returns the stored data like Chroma's get, either of all chunks or of the chunks with the given IDs,
+        so the ragchain and the offline scripts can read either store.
+        """
+        if ids is None:
+            rows = list(range(len(self.ids)))
+        else:
+            rows = [row for row in map(self.row_of, ids) if row is not None]
+
+        stored_data = {"ids": [self.ids[row] for row in rows]}
+        if "documents" in include:
+            stored_data["documents"] = [self.documents[row] for row in rows]
+        if "metadatas" in include:
+            stored_data["metadatas"] = [self._metadata(row) for row in rows]
+        if "embeddings" in include:
+            stored_data["embeddings"] = np.asarray(self.vectors[rows], dtype=np.float32)
+        return stored_data
+
+    def row_of(self, chunk_id):
+        """Returns the row of the chunk with the ID, or None."""
+        position = bisect_left(self.id_order, chunk_id, key=lambda row: self.ids[int(row)])
+        if position < len(self.id_order) and self.ids[int(self.id_order[position])] == chunk_id:
+            return int(self.id_order[position])
+        return None
+
+    def _filter_rows(self, filter):
+        candidates, exact = self.partitions.candidate_rows(filter)
+        if candidates is None:
+            candidates = np.arange(len(self.ids))
+        if exact:
+            return candidates
+        return np.asarray([row for row in candidates.tolist() if matches_filter(self._metadata(row), filter)], dtype=np.int64)
+
+    def _similarities(self, rows, query_vector, block_size=8192):
+        if len(rows) == len(self.ids):
+            matrix_rows = [self.vectors[start:start + block_size] for start in range(0, len(rows), block_size)]
+        else:
+            matrix_rows = [self.vectors[rows[start:start + block_size]] for start in range(0, len(rows), block_size)]
+        # float16 has no BLAS matmul, so the matrix is upcast block by block instead of all at once
+        return np.concatenate([np.asarray(block, dtype=np.float32) @ query_vector for block in matrix_rows])
+
+    def _metadata(self, row):
+        return json.loads(self.metadatas[row])
+
+    def _document(self, row):
+        return Document(page_content=self.documents[row], metadata=self._metadata(row))
+
+
+class StringBlob:
+    """
+    A read-only sequence of strings, stored as one UTF-8 blob (<path>.bin) and the array of the byte offsets
+    of the strings in it (<path>_offsets.npy). Both are memory-mapped, a string is only decoded when accessed.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def write(path, strings):
+        offsets = [0]
+        with open(f"{path}.bin", "wb") as file:
+            for string in strings:
+                offsets.append(offsets[-1] + file.write(string.encode("utf-8")))
+        np.save(f"{path}_offsets.npy", np.asarray(offsets, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        offsets = np.load(f"{path}_offsets.npy", mmap_mode="r")
+        # An empty file cannot be memory-mapped
+        data = np.memmap(f"{path}.bin", dtype=np.uint8, mode="r") if offsets[-1] > 0 else np.empty(0, dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.data[int(self.offsets[index]):int(self.offsets[index + 1])].tobytes().decode("utf-8")
@@ -0,0 +1,20 @@
+import json
+import os
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def write_manifest(vectorstore_path, manifest):
+    """Writes the manifest describing how the vectorstore was built next to its files."""
+    with open(os.path.join(vectorstore_path, MANIFEST_FILENAME), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+
+def read_manifest(vectorstore_path):
+    """Returns the manifest of the vectorstore, or an empty dict for vectorstores built without one."""
+    manifest_path = os.path.join(vectorstore_path, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, "r") as file:
+        return json.load(file)